@@ -15,12 +15,23 @@ aspectfit.py — обрезка и/или расширение изображе
 
   # Пакетно для папки:
   python aspectfit.py input_dir output_dir --aspect 4:5 --keep height --recursive
+
+  # Папка на 8 процессах; прерванный прогон продолжится с того же места
+  python aspectfit.py input_dir output_dir --aspect 4:5 --jobs 8 --skip-existing
 """
 import argparse
+import hashlib
+import json
+import math
 import os
+import time
+from collections import namedtuple
 from typing import Tuple, Literal
 from PIL import Image, ImageOps
 
+from tracing import span
+from utils import file_digest, ordered_map
+
 Gravity = Literal['center','top','bottom','left','right']
 
 def parse_aspect(s: str) -> float:
@@ -43,8 +54,81 @@ def _apply_exif_orientation(img: Image.Image) -> Image.Image:
     except Exception:
         return img
 
-def _crop_with_gravity(img: Image.Image, box_w: int, box_h: int, gravity: Gravity) -> Image.Image:
-    W, H = img.size
+def exif_orientation(img: Image.Image) -> int:
+    """EXIF Orientation (1..8) из заголовка, без декодирования пикселей."""
+    try:
+        return int(img.getexif().get(0x0112, 1))
+    except Exception:
+        return 1
+
+# Как в ImageOps.exif_transpose
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+_ROTATE_TRANSPOSE = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
+
+def orientation_ops(rotate: int = 0, orientation: int = 1):
+    """
+    Поворот img.rotate(rotate, expand=True) и затем EXIF-ориентация — как список
+    Image.Transpose (без потерь). None, если угол не кратен 90.
+    """
+    if rotate % 90:
+        return None
+    ops = []
+    if rotate % 360:
+        ops.append(_ROTATE_TRANSPOSE[rotate % 360])
+    if orientation in _EXIF_TRANSPOSE:
+        ops.append(_EXIF_TRANSPOSE[orientation])
+    return ops
+
+# Transpose как аффинное отображение нормированных координат исходника (s, t)
+# в координаты результата (p, q), обе системы — от левого верхнего угла:
+# p = a1*s + b1*t + c1, q = a2*s + b2*t + c2
+_TRANSPOSE_MATRICES = {
+    Image.Transpose.FLIP_LEFT_RIGHT: ((-1, 0, 1), (0, 1, 0)),
+    Image.Transpose.FLIP_TOP_BOTTOM: ((1, 0, 0), (0, -1, 1)),
+    Image.Transpose.ROTATE_90: ((0, 1, 0), (-1, 0, 1)),
+    Image.Transpose.ROTATE_180: ((-1, 0, 1), (0, -1, 1)),
+    Image.Transpose.ROTATE_270: ((0, -1, 1), (1, 0, 0)),
+    Image.Transpose.TRANSPOSE: ((0, 1, 0), (1, 0, 0)),
+    Image.Transpose.TRANSVERSE: ((0, -1, 1), (-1, 0, 1)),
+}
+
+def transpose_matrix(ops):
+    """Композиция Transpose (по порядку) как (a1, b1, c1, a2, b2, c2); a1 == 0 — оси меняются местами."""
+    a1, b1, c1, a2, b2, c2 = 1, 0, 0, 0, 1, 0
+    for op in ops:
+        (x1, y1, z1), (x2, y2, z2) = _TRANSPOSE_MATRICES[op]
+        a1, b1, c1, a2, b2, c2 = (
+            x1 * a1 + y1 * a2, x1 * b1 + y1 * b2, x1 * c1 + y1 * c2 + z1,
+            x2 * a1 + y2 * a2, x2 * b1 + y2 * b2, x2 * c1 + y2 * c2 + z2,
+        )
+    return a1, b1, c1, a2, b2, c2
+
+def _target_size(W: int, H: int, aspect: float, keep: str, prefer_integer: bool = True):
+    if keep == 'height':
+        target_h = H
+        target_w = aspect * target_h
+    else:
+        target_w = W
+        target_h = (1.0 / aspect) * target_w
+    if prefer_integer:
+        target_w = int(round(target_w))
+        target_h = int(round(target_h))
+    return target_w, target_h
+
+def _gravity_box(W: int, H: int, box_w: int, box_h: int, gravity: Gravity) -> Tuple[int,int,int,int]:
     left = (W - box_w) // 2
     top  = (H - box_h) // 2
     if gravity == 'left':
@@ -57,11 +141,9 @@ def _crop_with_gravity(img: Image.Image, box_w: int, box_h: int, gravity: Gravit
         top = H - box_h
     left = max(0, min(left, W - box_w))
     top  = max(0, min(top,  H - box_h))
-    return img.crop((left, top, left + box_w, top + box_h))
+    return (left, top, left + box_w, top + box_h)
 
-def _pad_with_gravity(img: Image.Image, box_w: int, box_h: int, gravity: Gravity, color: Tuple[int,int,int,int]) -> Image.Image:
-    W, H = img.size
-    canvas = Image.new('RGBA', (box_w, box_h), color)
+def _pad_offset(W: int, H: int, box_w: int, box_h: int, gravity: Gravity) -> Tuple[int,int]:
     x = (box_w - W) // 2
     y = (box_h - H) // 2
     if gravity == 'left':
@@ -72,8 +154,96 @@ def _pad_with_gravity(img: Image.Image, box_w: int, box_h: int, gravity: Gravity
         y = 0
     if gravity == 'bottom':
         y = box_h - H
-    canvas.paste(img, (x, y))
-    return canvas
+    return x, y
+
+def aspect_layout(
+    size: Tuple[int,int],
+    aspect: float,
+    keep: Literal['width','height'] = 'height',
+    crop_gravity: Gravity = 'center',
+    pad_gravity: Gravity = 'center',
+    prefer_integer: bool = True
+):
+    """
+    Геометрия to_aspect без пикселей: для изображения размера size (уже с учётом
+    EXIF-ориентации) возвращает (crop_box, canvas_size, paste_xy) — что вырезать,
+    какого размера итог и куда в нём лечь вырезанному (остальное — поля).
+    """
+    W, H = size
+    target_w, target_h = _target_size(W, H, aspect, keep, prefer_integer)
+    crop_w = W if target_w > W else int(target_w)
+    crop_h = H if target_h > H else int(target_h)
+    canvas_w, canvas_h = int(target_w), int(target_h)
+    crop_box = _gravity_box(W, H, crop_w, crop_h, crop_gravity)
+    return crop_box, (canvas_w, canvas_h), _pad_offset(crop_w, crop_h, canvas_w, canvas_h, pad_gravity)
+
+def _oriented(size: Tuple[int,int], ops) -> Tuple[int,int]:
+    """Размер после ops."""
+    return (size[1], size[0]) if transpose_matrix(ops)[0] == 0 else tuple(size)
+
+def _unorient_box(box, src_size: Tuple[int,int], ops) -> Tuple[int,int,int,int]:
+    """Коробку из кадра после ops — обратно в координаты исходника размера src_size."""
+    if not ops:
+        return tuple(box)
+    a1, b1, c1, a2, b2, c2 = transpose_matrix(ops)
+    W, H = src_size
+    oriented = _oriented(src_size, ops)
+    # матрица ортогональна — обратная к ней транспонированная
+    xs, ys = [], []
+    for x, y in ((box[0], box[1]), (box[2], box[3])):
+        p, q = x / oriented[0] - c1, y / oriented[1] - c2
+        xs.append(round((a1 * p + a2 * q) * W))
+        ys.append(round((b1 * p + b2 * q) * H))
+    return (min(xs), min(ys), max(xs), max(ys))
+
+# План «поворот + EXIF + to_aspect + resize»: вырезать box из исходных пикселей,
+# одним ресэмплом привести к size (ещё в ориентации исходника), затем transpose
+FitPlan = namedtuple('FitPlan', 'box size transpose')
+
+def plan_fit(
+    src_size: Tuple[int,int],
+    target_size: Tuple[int,int],
+    rotate: int = 0,
+    orientation: int = 1,
+    keep: Literal['width','height'] = 'height',
+    crop_gravity: Gravity = 'center'
+):
+    """
+    Считает FitPlan только по геометрии (размер из заголовка, угол, EXIF).
+    То же, что rotate(expand=True) -> exif_transpose -> to_aspect -> resize(target_size),
+    но без полнокадровых копий. None — если нужны поля или угол не кратен 90.
+    """
+    ops = orientation_ops(rotate, orientation)
+    if ops is None:
+        return None
+    crop_box, canvas, _ = aspect_layout(_oriented(src_size, ops), target_size[0] / target_size[1], keep, crop_gravity)
+    if canvas != (crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]):
+        return None
+    size = tuple(target_size[::-1]) if transpose_matrix(ops)[0] == 0 else tuple(target_size)
+    return FitPlan(_unorient_box(crop_box, src_size, ops), size, tuple(ops))
+
+def apply_fit_plan(img: Image.Image, plan, src_size=None, resample=Image.Resampling.LANCZOS) -> Image.Image:
+    """
+    Выполняет FitPlan: одна обрезка + один ресэмпл по исходным пикселям, потом
+    transpose уже маленькой картинки. src_size — размер, по которому считался план,
+    если img декодирован уменьшенным (draft/reduce): коробка масштабируется.
+    Результат — RGB (или L для серых JPEG); RGBA-копий кадра не делается.
+    """
+    box = plan.box
+    if src_size is not None and tuple(src_size) != img.size:
+        sx, sy = img.width / src_size[0], img.height / src_size[1]
+        box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+    if img.mode not in ('RGB', 'L'):
+        # конвертируем только вырезанное, а не весь кадр
+        whole = (math.floor(box[0]), math.floor(box[1]), math.ceil(box[2]), math.ceil(box[3]))
+        img = img.crop(whole).convert('RGB')
+        box = (box[0] - whole[0], box[1] - whole[1], box[2] - whole[0], box[3] - whole[1])
+    with span('resize'):
+        out = img.resize(plan.size, resample, box=box)
+    with span('transpose'):
+        for op in plan.transpose:
+            out = out.transpose(op)
+    return out
 
 def to_aspect(
     img: Image.Image,
@@ -89,32 +259,20 @@ def to_aspect(
     Обрезает или добавляет поля по второй стороне в зависимости от нехватки/избытка.
     Возвращает изображение в RGBA.
     """
-    img = _apply_exif_orientation(img).convert('RGBA')
-    W, H = img.size
-    if keep == 'height':
-        target_h = H
-        target_w = aspect * target_h
-    else:
-        target_w = W
-        target_h = (1.0 / aspect) * target_w
-    if prefer_integer:
-        target_w = int(round(target_w))
-        target_h = int(round(target_h))
-    # Решаем: обрезка или поля
-    if target_w <= W and target_h <= H:
-        # Обе стороны влезают: просто crop до коробки
-        return _crop_with_gravity(img, int(target_w), int(target_h), crop_gravity)
-    elif target_w > W and target_h <= H:
-        # Не хватает ширины: обрежем по высоте до target_h, а ширину дополним полями
-        cropped = _crop_with_gravity(img, W, int(target_h), crop_gravity)
-        return _pad_with_gravity(cropped, int(target_w), int(target_h), pad_gravity, pad_color)
-    elif target_w <= W and target_h > H:
-        # Не хватает высоты: обрежем по ширине до target_w, а высоту дополним
-        cropped = _crop_with_gravity(img, int(target_w), H, crop_gravity)
-        return _pad_with_gravity(cropped, int(target_w), int(target_h), pad_gravity, pad_color)
-    else:
-        # Обе стороны не хватает: паддинг по двум сторонам
-        return _pad_with_gravity(img, int(target_w), int(target_h), pad_gravity, pad_color)
+    # Геометрию считаем по заголовку: сначала режем, потом поворачиваем по EXIF
+    # и конвертируем в RGBA уже только вырезанное
+    ops = orientation_ops(0, exif_orientation(img))
+    crop_box, canvas, paste_xy = aspect_layout(_oriented(img.size, ops), aspect, keep, crop_gravity, pad_gravity,
+                                               prefer_integer)
+    cropped = img.crop(_unorient_box(crop_box, img.size, ops))
+    for op in ops:
+        cropped = cropped.transpose(op)
+    cropped = cropped.convert('RGBA')
+    if canvas == cropped.size:
+        return cropped
+    canvas_img = Image.new('RGBA', canvas, pad_color)
+    canvas_img.paste(cropped, paste_xy)
+    return canvas_img
 
 def process_one(
     inp_path: str,
@@ -126,17 +284,73 @@ def process_one(
     pad_color=(0,0,0,0),
     quality: int = 95
 ) -> None:
+    # Пишем во временный файл и переименовываем: недописанный результат
+    # прерванного прогона не примется --skip-existing за готовый
+    root, ext = os.path.splitext(out_path)
+    tmp_path = f"{root}.part{ext}"
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
     with Image.open(inp_path) as im:
         out = to_aspect(im, aspect, keep=keep, crop_gravity=crop_gravity, pad_gravity=pad_gravity, pad_color=pad_color)
         # Сохраняем с сохранением профиля, где возможно
-        ext = os.path.splitext(out_path.lower())[1]
-        if ext in ['.jpg', '.jpeg']:
-            out = out.convert('RGB')
-            out.save(out_path, quality=quality, subsampling=0, icc_profile=im.info.get('icc_profile'))
-        elif ext == '.png':
-            out.save(out_path, compress_level=6)
-        else:
-            out.save(out_path)
+        ext = ext.lower()
+        try:
+            if ext in ['.jpg', '.jpeg']:
+                out = out.convert('RGB')
+                out.save(tmp_path, quality=quality, subsampling=0, icc_profile=im.info.get('icc_profile'))
+            elif ext == '.png':
+                out.save(tmp_path, compress_level=6)
+            else:
+                out.save(tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, out_path)
+
+def _process_task(task):
+    """Задача для пула: (inp, out, kwargs) -> (inp, out, ошибка | None)."""
+    inp, out_path, kwargs = task
+    try:
+        process_one(inp, out_path, **kwargs)
+        return inp, out_path, None
+    except Exception as e:
+        return inp, out_path, str(e)
+
+# Состояние режима --skip-existing hash: хэш входа и параметров на каждый выход
+# ("outputs") и sha256 входов по (размер, mtime) ("files"), чтобы повторный
+# прогон не перечитывал все файлы, — как в buildstate.BuildManifest
+STATE_FILE = '.aspectfit-state.json'
+
+def _load_state(path: str):
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {'outputs': {}, 'files': {}}
+    if 'outputs' not in data:
+        # старый формат: только выход -> хэш
+        return {'outputs': data, 'files': {}}
+    return {'outputs': data.get('outputs', {}), 'files': data.get('files', {})}
+
+def _cached_digest(path: str, files) -> str:
+    st = os.stat(path)
+    cached = files.get(path)
+    if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+        return cached[2]
+    digest = file_digest(path)
+    files[path] = [st.st_size, st.st_mtime_ns, digest]
+    return digest
+
+def _params_digest(inp_path: str, kwargs, files) -> str:
+    params = json.dumps({k: v for k, v in kwargs.items()}, sort_keys=True, default=list)
+    return hashlib.sha256((_cached_digest(inp_path, files) + params).encode('utf-8')).hexdigest()
+
+def _is_done(inp: str, out_path: str, mode: str, state, digest) -> bool:
+    if not os.path.exists(out_path):
+        return False
+    if mode == 'mtime':
+        return os.path.getmtime(out_path) >= os.path.getmtime(inp)
+    return state['outputs'].get(out_path) == digest
 
 def _iter_files(root: str, recursive: bool):
     if os.path.isfile(root):
@@ -160,6 +374,10 @@ def main():
     ap.add_argument('--pad-color', default='0,0,0,0', help='RGBA как R,G,B[,A]. По умолчанию прозрачный.')
     ap.add_argument('--quality', type=int, default=95, help='JPEG качество')
     ap.add_argument('--recursive', action='store_true', help='рекурсивно обрабатывать папки')
+    ap.add_argument('--jobs', type=int, default=1, help='число процессов для папки')
+    ap.add_argument('--skip-existing', nargs='?', const='mtime', choices=['mtime', 'hash'],
+                    help='пропускать готовые: mtime — выход новее входа; hash — вход и параметры '
+                         f'не менялись (хранится в {STATE_FILE} в папке выхода)')
     args = ap.parse_args()
 
     aspect = parse_aspect(args.aspect)
@@ -180,9 +398,24 @@ def main():
         else:
             os.makedirs(args.output, exist_ok=True)
 
+    kwargs = dict(aspect=aspect, keep=args.keep, crop_gravity=args.crop_gravity, pad_gravity=args.pad_gravity,
+                  pad_color=pad_color, quality=args.quality)
+
     if input_is_file:
-        process_one(args.input, args.output, aspect, keep=args.keep, crop_gravity=args.crop_gravity, pad_gravity=args.pad_gravity, pad_color=pad_color, quality=args.quality)
-    else:
+        process_one(args.input, args.output, **kwargs)
+        return
+
+    state_path = os.path.join(args.output, STATE_FILE)
+    state = {'outputs': {}, 'files': {}}
+    if args.skip_existing == 'hash':
+        state = _load_state(state_path)
+
+    started = time.perf_counter()
+    digests = {}  # только для задач в работе
+    counts = {'skipped': 0}
+
+    def tasks():
+        # лениво: хэши и проверки идут, пока пул уже работает над первыми файлами
         for inp in _iter_files(args.input, args.recursive):
             try:
                 rel = os.path.relpath(inp, args.input)
@@ -190,11 +423,44 @@ def main():
                 rel = os.path.basename(inp)
             name, _ = os.path.splitext(rel)
             out_path = os.path.join(args.output, f"{name}.jpg")
-            try:
-                process_one(inp, out_path, aspect, keep=args.keep, crop_gravity=args.crop_gravity, pad_gravity=args.pad_gravity, pad_color=pad_color, quality=args.quality)
+            if os.path.abspath(inp) == os.path.abspath(state_path):
+                continue
+            if args.skip_existing:
+                digest = None
+                if args.skip_existing == 'hash':
+                    try:
+                        digest = digests[out_path] = _params_digest(inp, kwargs, state['files'])
+                    except OSError:
+                        pass
+                if _is_done(inp, out_path, args.skip_existing, state, digest):
+                    counts['skipped'] += 1
+                    digests.pop(out_path, None)
+                    print(f"SKIP: {inp} -> {out_path}")
+                    continue
+            yield inp, out_path, kwargs
+
+    done = failed = 0
+    try:
+        # ordered_map отдаёт результаты в порядке входа — отчёт не перемешивается
+        for inp, out_path, error in ordered_map(_process_task, tasks(), max(args.jobs, 1)):
+            if error is None:
+                done += 1
                 print(f"OK: {inp} -> {out_path}")
-            except Exception as e:
-                print(f"FAIL: {inp} ({e})")
+                if out_path in digests:
+                    state['outputs'][out_path] = digests[out_path]
+            else:
+                failed += 1
+                print(f"FAIL: {inp} ({error})")
+            digests.pop(out_path, None)
+    finally:
+        if args.skip_existing == 'hash':
+            with open(state_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, indent=1)
+    skipped = counts['skipped']
+
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"Готово: {done} ок, {skipped} пропущено, {failed} ошибок за {elapsed:.1f} с ({rate:.2f} изобр./с)")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,219 @@
+"""
+assets.py — кэш шрифтов и декодированных слоёв на процесс.
+
+Все горизонтальные карточки рисуются на одном layout/default_layer.png, все
+вертикальные — на default_vertical_layer.png, и шрифтов у них два. Поэтому
+шрифт грузится один раз на (путь, размер, mtime), слой декодируется один раз
+на (путь, mtime), а карточка получает дешёвую копию уже декодированного слоя.
+Размеры строк текста (для подбора кегля под рамку) тоже запоминаются.
+Изменённый на диске файл даёт новый ключ и перечитывается.
+
+Обработанные фото (повёрнутые, обрезанные и уменьшенные под страницу) тоже
+кэшируются: одно фото часто идёт в несколько карточек — горизонтальную и
+вертикальную, с разными названиями, в перепечатку. Ключ — хэш содержимого
+файла и параметры подгонки. Оба уровня по умолчанию выключены:
+- в памяти — LRU по байтам; его включает тот, кто знает, что фото повторятся
+  (run.render_batch — только если в пакете есть повторы, и тогда учитывает
+  лимит в бюджете памяти; сервер — всегда), лимит наследуют процессы пула;
+- на диске (run.py --photo-cache DIR) — сырые пиксели, общие для процессов
+  пула и запусков. Диск не чистится сам: каталог можно удалить в любой момент.
+"""
+import hashlib
+import os
+import threading
+
+from PIL import Image, ImageFont
+
+from memory import image_bytes
+from utils import LRUCache, file_digest
+
+FONT_CACHE_ITEMS = 64
+# RGBA-слой 1040×1460 — ~6 МБ; с запасом на десяток разных раскладок
+LAYOUT_CACHE_BYTES = 128 * 1024 * 1024
+# Фото на странице 600 dpi — ~35 МБ в RGB: около семи последних фото
+PHOTO_CACHE_BYTES = 256 * 1024 * 1024
+DIGEST_CACHE_ITEMS = 4096
+# Размеры строк для подбора кегля: (шрифт, кегль, текст) -> bbox или ширина, записи крошечные
+TEXT_CACHE_ITEMS = 65536
+# Меняется, когда меняется сама подгонка фото, — старые файлы на диске не подходят
+PHOTO_CACHE_VERSION = 1
+PHOTO_CACHE_ENV = 'CARDS_PHOTO_CACHE'
+PHOTO_MEMORY_ENV = 'CARDS_PHOTO_CACHE_BYTES'
+
+_fonts = LRUCache(max_items=FONT_CACHE_ITEMS)
+_layouts = LRUCache(max_weight=LAYOUT_CACHE_BYTES)
+# max_weight=0: ничего не кладётся, пока set_photo_memory_limit не включит
+_photos = LRUCache(max_weight=int(os.environ.get(PHOTO_MEMORY_ENV) or 0))
+_digests = LRUCache(max_items=DIGEST_CACHE_ITEMS)
+_text_metrics = LRUCache(max_items=TEXT_CACHE_ITEMS)
+_photo_dir = os.environ.get(PHOTO_CACHE_ENV) or None
+_disk = {'hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+
+def get_font(path, size):
+    """ImageFont.truetype из кэша. FileNotFoundError, если файла нет."""
+    key = (path, size, os.stat(path).st_mtime_ns)
+    font = _fonts.get(key)
+    if font is None:
+        font = ImageFont.truetype(path, size)
+        _fonts.put(key, font)
+    return font
+
+
+def get_text_bbox(path, size, text):
+    """
+    font.getbbox(text) из кэша по (шрифт, кегль, mtime, текст) — подбор кегля
+    меряет одни и те же строки много раз, а рисует один.
+    """
+    return _text_metric('bbox', path, size, text)
+
+
+def get_text_length(path, size, text):
+    """font.getlength(text) (ширина по advance) из того же кэша — для переноса по словам."""
+    return _text_metric('length', path, size, text)
+
+
+def _text_metric(kind, path, size, text):
+    key = (kind, path, size, os.stat(path).st_mtime_ns, text)
+    value = _text_metrics.get(key)
+    if value is None:
+        font = get_font(path, size)
+        value = font.getbbox(text) if kind == 'bbox' else font.getlength(text)
+        _text_metrics.put(key, value)
+    return value
+
+
+def get_layout(path):
+    """Слой в RGBA — своя копия для карточки, на ней можно рисовать."""
+    key = (path, os.stat(path).st_mtime_ns)
+    layout = _layouts.get(key)
+    if layout is None:
+        with Image.open(path) as img:
+            layout = img.convert("RGBA")
+        _layouts.put(key, layout, weight=layout.width * layout.height * 4)
+    return layout.copy()
+
+
+def get_layer(key, build):
+    """
+    Готовый RGBA-слой по ключу: build() вызывается только при промахе.
+    Ключ должен включать всё, от чего зависит картинка (пути, mtime, тексты).
+    Возвращается своя копия — на ней можно рисовать.
+    """
+    layer = _layouts.get(key)
+    if layer is None:
+        layer = build()
+        _layouts.put(key, layer, weight=layer.width * layer.height * 4)
+    return layer.copy()
+
+
+def content_digest(path):
+    """sha256 файла; пересчитывается, только если изменились размер или mtime."""
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    digest = _digests.get(key)
+    if digest is None:
+        digest = file_digest(path)
+        _digests.put(key, digest)
+    return digest
+
+
+def set_photo_memory_limit(max_bytes):
+    """Лимит кэша фото в памяти для этого процесса и порождённых; 0 — выключен."""
+    max_bytes = int(max_bytes or 0)
+    os.environ[PHOTO_MEMORY_ENV] = str(max_bytes)
+    _photos.max_weight = max_bytes
+    if _photos.weight > max_bytes:
+        _photos.clear()
+
+
+def set_photo_disk_cache(path):
+    """Дисковый уровень кэша фото в этом процессе и порождённых; None — выключен."""
+    global _photo_dir
+    if path is None:
+        os.environ.pop(PHOTO_CACHE_ENV, None)
+    else:
+        os.makedirs(path, exist_ok=True)
+        os.environ[PHOTO_CACHE_ENV] = path
+    _photo_dir = path
+
+
+def _photo_file(key):
+    name = hashlib.sha256(repr((PHOTO_CACHE_VERSION,) + tuple(key)).encode('utf-8')).hexdigest()
+    return os.path.join(_photo_dir, name + '.raw')
+
+
+def _read_photo(path):
+    """Фото из сырого файла: строка "режим ширина высота", затем пиксели. None — нет или битый."""
+    try:
+        with open(path, 'rb') as f:
+            mode, width, height = f.readline().decode('ascii').split()
+            return Image.frombytes(mode, (int(width), int(height)), f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_photo(path, img):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(f"{img.mode} {img.width} {img.height}\n".encode('ascii'))
+            f.write(img.tobytes())
+        os.replace(tmp_path, path)
+    except OSError:
+        # кэш необязателен: нет места или прав — просто не сохраняем
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def photo_cache_enabled():
+    """Включён ли хоть один уровень кэша фото — иначе и ключ (sha256 фото) считать незачем."""
+    return _photos.max_weight > 0 or _photo_dir is not None
+
+
+def find_photo(key):
+    """
+    Обработанное фото по ключу — из памяти, потом с диска; None, если нет.
+    Картинка общая для всех, кто её получил: только читать (paste, encode).
+    """
+    img = _photos.get(key)
+    if img is not None or _photo_dir is None:
+        return img
+    img = _read_photo(_photo_file(key))
+    with _lock:
+        _disk['hits' if img is not None else 'misses'] += 1
+    if img is not None:
+        _photos.put(key, img, weight=image_bytes(img.size, img.mode))
+    return img
+
+
+def put_photo(key, img):
+    """Положить обработанное фото в кэш (и на диск, если он включён)."""
+    _photos.put(key, img, weight=image_bytes(img.size, img.mode))
+    if _photo_dir is not None and img.mode != 'P':  # палитра в сырые пиксели не влезет
+        _write_photo(_photo_file(key), img)
+
+
+def stats():
+    """Попадания и промахи кэшей — для /stats сервера."""
+    out = {
+        name: {'items': len(cache), 'hits': cache.hits, 'misses': cache.misses}
+        for name, cache in (('fonts', _fonts), ('text', _text_metrics), ('layers', _layouts), ('photos', _photos))
+    }
+    out['layers']['bytes'] = _layouts.weight
+    out['photos']['bytes'] = _photos.weight
+    out['photos']['limit'] = _photos.max_weight
+    if _photo_dir is not None:
+        with _lock:
+            out['photos']['disk'] = dict(_disk, path=_photo_dir)
+    return out
+
+
+def clear():
+    """Очистить кэши в памяти; дисковый уровень фото остаётся."""
+    _fonts.clear()
+    _text_metrics.clear()
+    _layouts.clear()
+    _photos.clear()
+    _digests.clear()
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+bench.py — замеры скорости рендера открыток.
+
+Примеры:
+  # Декод фото: полный против уменьшенного (draft/reduce), с проверкой разницы
+  python bench.py decode
+  python bench.py decode card_images/IMG20230424205517.jpg --repeat 5
+
+  # deep_merge: с копированием против общих поддеревьев на больших конфигах
+  python bench.py merge --keys 2000 --depth 4
+
+  # Сдвиг сканов (move.py): прежний NumPy против Pillow, по файлу и пакетом
+  python bench.py move --size 4000 3000 --files 16 -j 4
+
+  # Набор замеров всего рендера на синтетических фото 12/50/108 Мп:
+  # время (wall/CPU) и пик памяти в JSON, сравнение с сохранённым эталоном
+  python bench.py suite --save tmp/bench/baseline.json
+  python bench.py suite --baseline tmp/bench/baseline.json   # код 1 при регрессии
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import PIL
+from PIL import Image, ImageDraw
+
+import move
+import run
+from assets import set_photo_disk_cache, set_photo_memory_limit
+from aspectfit import parse_aspect, to_aspect
+from memory import peak_rss, reset_peak_rss
+from utils import deep_merge
+
+# Синтетическое фото «как с телефона на 50 Мп» — из реального кадра апскейлом
+SYNTHETIC_SIZE = (8160, 6120)
+
+
+def _timeit(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+def _psnr(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    mse = float(np.mean((a - b) ** 2))
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+
+def _synthetic_photo(src, out_dir):
+    out = os.path.join(out_dir, 'synthetic_50mp.jpg')
+    with Image.open(src) as im:
+        im.convert('RGB').resize(SYNTHETIC_SIZE, Image.Resampling.BICUBIC).save(out, quality=92)
+    return out
+
+
+def bench_decode(args):
+    image_width_px = int(run.CARD_WIDTH * run.DPI / 25.4)
+    image_height_px = int(run.CARD_HEIGHT * run.DPI / 25.4)
+
+    photos = args.photos or sorted(glob.glob('card_images/*.jpg') + glob.glob('card_images/*.JPG'))
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.no_synthetic and photos:
+            photos = photos + [_synthetic_photo(photos[0], tmp)]
+
+        print(f"{'фото':<48} {'full, s':>8} {'draft, s':>8} {'x':>6} {'PSNR, dB':>9}")
+        for path in photos:
+            info = {'path': path, 'adoptation': 'aspect_fit', 'gravity': 'center', 'rotate': args.rotate}
+            t_full, full = _timeit(lambda: run.prepare_image(info, image_width_px, image_height_px, draft=False), args.repeat)
+            t_draft, reduced = _timeit(lambda: run.prepare_image(info, image_width_px, image_height_px, draft=True), args.repeat)
+            psnr = _psnr(full.convert('RGB'), reduced.convert('RGB'))
+            name = os.path.basename(path)
+            print(f"{name:<48} {t_full:>8.3f} {t_draft:>8.3f} {t_full / t_draft:>6.2f} {psnr:>9.2f}")
+            if psnr < args.min_psnr:
+                print(f"  ВНИМАНИЕ: PSNR ниже {args.min_psnr} dB — результат заметно отличается")
+
+
+def _synthetic_config(keys, depth, fanout, seed):
+    """Широкое дерево: keys ключей верхнего уровня, под каждым depth уровней по fanout."""
+    def node(level, salt):
+        if level == depth:
+            return {'value': salt, 'tags': [salt, salt + 1], 'items': [{'id': i, 'v': salt} for i in range(3)]}
+        return {f'n{i}': node(level + 1, salt * fanout + i) for i in range(fanout)}
+    return {f'k{i}': node(0, seed + i) for i in range(keys)}
+
+
+def _overlay(config, every):
+    """Карточка поверх родителя: меняет каждый every-й ключ по одному пути вглубь."""
+    out = {}
+    for i, key in enumerate(config):
+        if i % every:
+            continue
+        node, path = config[key], []
+        while isinstance(node, dict) and 'value' not in node:
+            first = next(iter(node))
+            path.append(first)
+            node = node[first]
+        leaf = {'value': -1, 'tags': [-1], 'items': [{'id': 0, 'v': -1}]}
+        for part in reversed(path):
+            leaf = {part: leaf}
+        out[key] = leaf
+    return out
+
+
+def bench_merge(args):
+    base = _synthetic_config(args.keys, args.depth, args.fanout, 0)
+    overlay = _overlay(base, args.every)
+    print(f"конфиг: {args.keys} ключей, глубина {args.depth}, ветвление {args.fanout}; "
+          f"меняется каждый {args.every}-й ключ")
+
+    print(f"{'стратегия':<10} {'copy, ms':>10} {'shared, ms':>11} {'x':>7}")
+    for strategy in ('extend', 'unique', 'by_index', 'by_key'):
+        kw = {'list_strategy': strategy, 'list_key': 'id' if strategy == 'by_key' else None}
+        t_copy, r_copy = _timeit(lambda: deep_merge(base, overlay, copy=True, **kw), args.repeat)
+        t_shared, r_shared = _timeit(lambda: deep_merge(base, overlay, copy=False, **kw), args.repeat)
+        if r_copy != r_shared:
+            raise SystemExit(f"{strategy}: результаты copy=True и copy=False различаются")
+        print(f"{strategy:<10} {t_copy * 1000:>10.1f} {t_shared * 1000:>11.1f} {t_copy / t_shared:>7.1f}")
+
+
+def _legacy_shift(img, move_size):
+    """Прежний move.process_image (NumPy: срез + повтор столбца + concatenate) — эталон для сравнения."""
+    arr = np.array(img)
+    cropped = arr[:, :arr.shape[1] - move_size]
+    return Image.fromarray(np.concatenate([np.repeat(cropped[:, :1], move_size, axis=1), cropped], axis=1))
+
+
+def _legacy_move(input_path, output_path, move_size):
+    with Image.open(input_path) as img:
+        _legacy_shift(img, move_size).save(output_path)
+
+
+def _scan(path, mode, size, seed):
+    """Синтетический «скан»: шум в нужном режиме (RGB, L, P с палитрой, I;16)."""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    if mode == 'I;16':
+        img = Image.fromarray(rng.integers(0, 65536, (h, w), dtype=np.uint16))
+    else:
+        img = Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+        if mode == 'P':
+            img = img.quantize(64)
+        elif mode != 'RGB':
+            img = img.convert(mode)
+    img.save(path)
+    return path
+
+
+def bench_move(args):
+    size = tuple(args.size)
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"скан {size[0]}x{size[1]}, сдвиг {args.dx} px")
+        print(f"{'режим':<6} {'сдвиг numpy, ms':>16} {'pillow, ms':>11} {'x':>6} "
+              f"{'файл numpy, ms':>15} {'pillow, ms':>11} {'x':>6}  результат")
+        for mode in ('RGB', 'L', 'P', 'I;16'):
+            src = _scan(os.path.join(tmp, f"src_{mode.replace(';', '')}.png"), mode, size, 0)
+            with Image.open(src) as img:
+                img.load()
+            t_old, old = _timeit(lambda: _legacy_shift(img, args.dx), args.repeat)
+            t_new, new = _timeit(lambda: move.shift_image(img, args.dx), args.repeat)
+            if new.mode != img.mode or new.getpalette() != img.getpalette():
+                raise SystemExit(f"{mode}: режим или палитра не сохранились ({img.mode} -> {new.mode})")
+            if not np.array_equal(np.asarray(old), np.asarray(new)):
+                raise SystemExit(f"{mode}: пиксели отличаются от прежнего результата")
+            note = 'совпадает' if old.mode == img.mode else f"совпадает, numpy терял режим ({img.mode} -> {old.mode})"
+
+            old_path, new_path = os.path.join(tmp, 'old.png'), os.path.join(tmp, 'new.png')
+            f_old, _ = _timeit(lambda: _legacy_move(src, old_path, args.dx), args.repeat)
+            f_new, _ = _timeit(lambda: move.process_image(src, new_path, args.dx), args.repeat)
+            print(f"{mode:<6} {t_old * 1000:>16.1f} {t_new * 1000:>11.1f} {t_old / t_new:>6.2f} "
+                  f"{f_old * 1000:>15.1f} {f_new * 1000:>11.1f} {f_old / f_new:>6.2f}  {note}")
+
+        # пакет: прежний код по одному файлу против потока через пул процессов
+        src_dir, out_dir = os.path.join(tmp, 'batch'), os.path.join(tmp, 'out')
+        os.makedirs(src_dir)
+        for i in range(args.files):
+            _scan(os.path.join(src_dir, f"{i:04d}.png"), 'RGB', size, i)
+        names = sorted(os.listdir(src_dir))
+        os.makedirs(out_dir)
+        t0 = time.perf_counter()
+        for name in names:
+            _legacy_move(os.path.join(src_dir, name), os.path.join(out_dir, name), args.dx)
+        t_old = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        failed = [r for r in move.process_batch(move.iter_tasks(src_dir, out_dir, args.dx, 0), args.jobs) if r[2]]
+        t_new = time.perf_counter() - t0
+        if failed:
+            raise SystemExit(f"пакет: {failed[0][0]}: {failed[0][2]}")
+        print(f"пакет {len(names)} файлов: numpy {len(names) / t_old:.2f} изобр./с, "
+              f"pillow -j {args.jobs} {len(names) / t_new:.2f} изобр./с (x{t_old / t_new:.2f})")
+
+
+# Мегапиксели -> размер кадра 4:3, как у телефонных камер
+SUITE_SIZES = {12: (4000, 3000), 50: (8160, 6120), 108: (12000, 9000)}
+SUITE_LAYOUT_SIZE = (1460, 1040)
+SUITE_FONT = 'fonts/NotoSerifDisplay-Italic.ttf'
+EXIF_ORIENTATION = 0x0112
+
+
+def _suite_photo(data_dir, mp, fmt, exif):
+    """
+    Синтетическое фото: плавный шум с фиксированным seed, растянутый до
+    нужного размера (жмётся как фото, а не как белый шум). С exif — тот же
+    кадр, но с ориентацией 6 (повернуть на 90°). Готовый файл переиспользуется.
+    """
+    ext = {'jpeg': 'jpg', 'png': 'png'}[fmt]
+    path = os.path.join(data_dir, f"photo_{mp}mp{'_exif6' if exif else ''}.{ext}")
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(mp)
+    small = Image.fromarray(rng.integers(0, 256, (48, 64, 3), dtype=np.uint8), 'RGB')
+    img = small.resize(SUITE_SIZES[mp], Image.Resampling.BICUBIC)
+    kwargs = {'quality': 92} if fmt == 'jpeg' else {'compress_level': 1}
+    if exif:
+        exif_data = Image.Exif()
+        exif_data[EXIF_ORIENTATION] = 6
+        kwargs['exif'] = exif_data
+    tmp_path = path + '.part.' + ext
+    img.save(tmp_path, **kwargs)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _suite_layout(data_dir):
+    """Слой карточки: белая рамка с прозрачным окном под фото."""
+    path = os.path.join(data_dir, 'layout.png')
+    if not os.path.exists(path):
+        img = Image.new('RGBA', SUITE_LAYOUT_SIZE, (255, 255, 255, 255))
+        w, h = SUITE_LAYOUT_SIZE
+        ImageDraw.Draw(img).rectangle((w // 10, h // 10, w * 9 // 10, h * 7 // 10), fill=(0, 0, 0, 0))
+        img.save(path)
+    return path
+
+
+def _suite_config(photo, layout, out_dir, name):
+    return {
+        'layout': {'path': layout},
+        'username_info': {'content': '@bench', 'font': SUITE_FONT, 'position': [1200, 900]},
+        'cardname_info': {'content': 'Синтетическая карточка', 'font': SUITE_FONT, 'position': [180, 220]},
+        'image': {'path': photo, 'gravity': 'center'},
+        'output_pdf': os.path.join(out_dir, name + '.pdf'),
+    }
+
+
+def _suite_cases(args, data_dir, out_dir):
+    """(имя, setup() -> состояние, fn(состояние)) — setup в замер не входит."""
+    image_size, _ = run.page_sizes(run.DPI)
+    layout = _suite_layout(data_dir)
+    cases = []
+
+    def load(path):
+        def setup():
+            with Image.open(path) as img:
+                img.load()
+                return img.copy()
+        return setup
+
+    for mp in args.sizes:
+        for fmt in args.formats:
+            for exif in (False, True):
+                photo = _suite_photo(data_dir, mp, fmt, exif)
+                variant = f"{mp}mp-{fmt}{'-exif6' if exif else ''}"
+                info = {'path': photo, 'adoptation': 'aspect_fit', 'gravity': 'center', 'rotate': 0}
+                aspect = parse_aspect(f"{image_size[0]}:{image_size[1]}")
+                config = _suite_config(photo, layout, out_dir, variant)
+                cases += [
+                    (f"to_aspect/{variant}", load(photo), lambda img, a=aspect: to_aspect(img, aspect=a)),
+                    (f"resize_image_to_exact/{variant}", load(photo),
+                     lambda img: run.resize_image_to_exact(img, *image_size, gravity='center')),
+                    (f"images_to_pdf/{variant}", lambda i=info: [i],
+                     lambda images, o=os.path.join(out_dir, variant + '.photo.pdf'): run.images_to_pdf(images, o)),
+                    (f"process_card/{variant}", lambda c=config: c, lambda c: run.process_card(c)),
+                ]
+                if fmt == 'png' and not exif:
+                    cases.append((f"move.process_image/{variant}", lambda p=photo: p,
+                                  lambda p, o=os.path.join(out_dir, variant + '.move.png'): move.process_image(p, o, 12)))
+
+    def text_setup():
+        with Image.open(layout) as img:
+            return img.convert('RGBA')
+
+    def text(img):
+        draw = ImageDraw.Draw(img)
+        for i in range(20):
+            run.draw_text(draw, f"Карточка {i}", (100, 40 * i), font_name=SUITE_FONT, font_size=60)
+
+    cases.append(('draw_text/20-lines', text_setup, text))
+
+    base = _synthetic_config(1000, 3, 3, 0)
+    overlay = _overlay(base, 50)
+    cases.append(('deep_merge/1000-keys', lambda: (base, overlay), lambda ab: deep_merge(*ab)))
+    cases.append(('deep_merge/1000-keys-shared', lambda: (base, overlay), lambda ab: deep_merge(*ab, copy=False)))
+    return cases
+
+
+def _measure(setup, fn, repeat):
+    """Лучшее wall-время из repeat, CPU того же прогона и наибольший пик RSS над уровнем после setup."""
+    best = None
+    peak = None
+    for _ in range(repeat):
+        state = setup()
+        base = reset_peak_rss()
+        w0, c0 = time.perf_counter(), time.process_time()
+        fn(state)
+        wall, cpu = time.perf_counter() - w0, time.process_time() - c0
+        if base is not None:
+            delta = peak_rss() - base
+            peak = delta if peak is None else max(peak, delta)
+        del state
+        if best is None or wall < best[0]:
+            best = (wall, cpu)
+    return {'wall_s': round(best[0], 4), 'cpu_s': round(best[1], 4),
+            'peak_mb': None if peak is None else round(peak / 2 ** 20, 1)}
+
+
+def _compare(results, baseline, time_tolerance, memory_tolerance, min_delta):
+    """
+    Печатает сравнение и возвращает регрессии против эталона (только общие замеры).
+    Замедление засчитывается, если оно больше и доли time_tolerance, и min_delta
+    секунд — иначе миллисекундные замеры шумят.
+    """
+    regressions = []
+    print(f"{'замер':<44} {'wall, s':>8} {'эталон':>8} {'x':>6} {'пик, МБ':>8} {'эталон':>8}")
+    for name, cur in results.items():
+        ref = baseline.get(name)
+        if ref is None:
+            print(f"{name:<44} {cur['wall_s']:>8.3f} {'—':>8}")
+            continue
+        ratio = cur['wall_s'] / ref['wall_s'] if ref['wall_s'] else 1.0
+        mark = ''
+        if ratio > 1 + time_tolerance and cur['wall_s'] - ref['wall_s'] > min_delta:
+            mark = '  РЕГРЕССИЯ: время'
+            regressions.append(name)
+        if (cur['peak_mb'] is not None and ref.get('peak_mb')
+                and cur['peak_mb'] > ref['peak_mb'] * (1 + memory_tolerance) + 1):
+            mark += '  РЕГРЕССИЯ: память'
+            regressions.append(name)
+        print(f"{name:<44} {cur['wall_s']:>8.3f} {ref['wall_s']:>8.3f} {ratio:>6.2f} "
+              f"{cur['peak_mb'] or 0:>8.1f} {ref.get('peak_mb') or 0:>8.1f}{mark}")
+    return regressions
+
+
+def bench_suite(args):
+    # кэш обработанных фото отдал бы повторам готовую страницу — замерялись бы
+    # попадания, а не декод и ресайз; выключаем оба уровня, даже унаследованные
+    set_photo_memory_limit(0)
+    set_photo_disk_cache(None)
+    data_dir = args.data
+    os.makedirs(data_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as out_dir:
+        cases = _suite_cases(args, data_dir, out_dir)
+        if args.only:
+            cases = [c for c in cases if any(part in c[0] for part in args.only)]
+        results = {}
+        for name, setup, fn in cases:
+            results[name] = _measure(setup, fn, args.repeat)
+            r = results[name]
+            print(f"{name:<44} wall {r['wall_s']:>8.3f} s  cpu {r['cpu_s']:>8.3f} s  пик {r['peak_mb']} МБ",
+                  flush=True)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or '.', exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        print(f"Результаты: {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        print()
+        regressions = _compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.min_delta)
+        if regressions:
+            raise SystemExit(f"Регрессии ({len(regressions)}): {', '.join(sorted(set(regressions)))}")
+        print("Регрессий нет")
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Замеры скорости рендера открыток.')
+    sub = ap.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('decode', help='полный декод фото против уменьшенного')
+    p.add_argument('photos', nargs='*', help='фото (по умолчанию card_images/*.jpg)')
+    p.add_argument('--rotate', type=int, default=0, help='поворот, как в конфиге карточки')
+    p.add_argument('--repeat', type=int, default=3, help='повторов на замер (берётся лучший)')
+    p.add_argument('--min-psnr', type=float, default=38.0, help='порог визуальной эквивалентности, дБ')
+    p.add_argument('--no-synthetic', action='store_true', help='не генерировать фото на 50 Мп')
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser('merge', help='deep_merge: с копированием против общих поддеревьев')
+    p.add_argument('--keys', type=int, default=1000, help='ключей верхнего уровня')
+    p.add_argument('--depth', type=int, default=3, help='глубина вложенности')
+    p.add_argument('--fanout', type=int, default=3, help='ветвление на каждом уровне')
+    p.add_argument('--every', type=int, default=50, help='карточка меняет каждый N-й ключ')
+    p.add_argument('--repeat', type=int, default=3, help='повторов на замер (берётся лучший)')
+    p.set_defaults(func=bench_merge)
+
+    p = sub.add_parser('move', help='сдвиг сканов: прежний NumPy против Pillow, по файлу и пакетом')
+    p.add_argument('--size', type=int, nargs=2, default=[4000, 3000], metavar=('W', 'H'), help='размер скана')
+    p.add_argument('--dx', type=int, default=move.DEFAULT_DX, help='сдвиг вправо, px')
+    p.add_argument('--files', type=int, default=16, help='файлов в пакете')
+    p.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='процессов для пакета')
+    p.add_argument('--repeat', type=int, default=3, help='повторов на замер (берётся лучший)')
+    p.set_defaults(func=bench_move)
+
+    p = sub.add_parser('suite', help='все стадии рендера на синтетических фото: время, CPU, пик памяти')
+    p.add_argument('--sizes', type=lambda v: [int(x) for x in v.split(',')], default=sorted(SUITE_SIZES),
+                   help=f"мегапиксели через запятую из {sorted(SUITE_SIZES)} (по умолчанию все)")
+    p.add_argument('--formats', type=lambda v: v.split(','), default=['jpeg', 'png'],
+                   help='jpeg,png (по умолчанию оба)')
+    p.add_argument('--only', nargs='*', help='только замеры, в имени которых есть эти подстроки')
+    p.add_argument('--repeat', type=int, default=3, help='повторов на замер (берётся лучший)')
+    p.add_argument('--data', default='tmp/bench', help='куда класть синтетические фото (переиспользуются)')
+    p.add_argument('--save', metavar='JSON', help='записать результаты в JSON')
+    p.add_argument('--baseline', metavar='JSON', help='сравнить с сохранённым эталоном; регрессия — код 1')
+    p.add_argument('--time-tolerance', type=float, default=0.15, help='допустимое замедление (доля)')
+    p.add_argument('--min-delta', type=float, default=0.01, help='замедление меньше стольких секунд — шум')
+    p.add_argument('--memory-tolerance', type=float, default=0.15, help='допустимый рост пика памяти (доля)')
+    p.set_defaults(func=bench_suite)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
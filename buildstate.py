@@ -0,0 +1,64 @@
+"""
+buildstate.py — манифест инкрементальной сборки.
+
+На каждый выходной PDF храним хэш всех его входов (итоговый конфиг, фото, слой,
+шрифты, константы рендера). Если хэш не изменился и PDF на месте — карточку
+можно не пересобирать. Хэши файлов кэшируются по (размер, mtime), чтобы
+повторный прогон по сотням карточек не перечитывал все фото.
+"""
+import hashlib
+import json
+import os
+
+from utils import file_digest
+
+MANIFEST_VERSION = 1
+
+
+class BuildManifest:
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}  # output_pdf -> хэш входов
+        self.files = {}    # путь -> [size, mtime_ns, sha256]
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        # манифест другой версии или битый — просто собираем всё заново
+        if isinstance(data, dict) and data.get('version') == MANIFEST_VERSION:
+            self.outputs = data.get('outputs', {})
+            self.files = data.get('files', {})
+
+    def file_digest(self, path):
+        st = os.stat(path)
+        cached = self.files.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = file_digest(path)
+        self.files[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def inputs_digest(self, config, files, constants):
+        """Хэш входов карточки; падает, если какого-то файла нет."""
+        payload = {
+            'config': config,
+            'files': {p: self.file_digest(p) for p in sorted(set(files))},
+            'constants': constants,
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def is_fresh(self, output, digest):
+        return self.outputs.get(output) == digest and os.path.exists(output)
+
+    def record(self, output, digest):
+        self.outputs[output] = digest
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'outputs': self.outputs, 'files': self.files},
+                      f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
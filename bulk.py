@@ -0,0 +1,105 @@
+"""
+bulk.py — карточки из одного файла-списка (JSONL или CSV) вместо JSON на карточку.
+
+Строка — переопределения поверх родительского конфига: "parent" плюс то, что
+отличается (название, фото, gravity, путь результата). Итоговый конфиг
+собирается тем же резолвером (utils.deep_merge), что и для файлов. Файл
+читается построчно, так что тысячи строк не держатся в памяти.
+
+JSONL — объект на строку; CSV — заголовок и строки. В обоих можно писать
+короткие имена (см. FIELD_ALIASES) и пути через точку: "image.gravity".
+Пример CSV:
+  parent,title,photo,gravity,output
+  cards/global_vertical.json,Au Pont Rouge,card_images/IMG1.jpg,right,tmp/a.pdf
+"""
+import csv
+import json
+import os
+
+# короткое имя колонки -> путь ключа в конфиге карточки
+FIELD_ALIASES = {
+    'title': ('cardname_info', 'content'),
+    'username': ('username_info', 'content'),
+    'photo': ('image', 'path'),
+    'gravity': ('image', 'gravity'),
+    'rotate': ('image', 'rotate'),
+    'output': ('output_pdf',),
+}
+INT_FIELDS = {('image', 'rotate'), ('layout', 'rotate')}
+# Ключи, значение которых всегда строка — даже "[Черновик] Осень" не JSON
+TEXT_KEYS = {'content', 'path', 'font', 'gravity', 'output_pdf'}
+
+
+def _key_path(name):
+    return FIELD_ALIASES.get(name) or tuple(name.split('.'))
+
+
+def _cell(path, value):
+    """
+    Значение CSV-ячейки: числа — для числовых полей; [..]/{..} в нетекстовых
+    полях (position и т.п.) — как JSON, если разбирается; остальное строкой.
+    """
+    if path in INT_FIELDS:
+        return int(value)
+    if path[-1] not in TEXT_KEYS and value[:1] in '[{':
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def row_to_config(row, from_csv=False):
+    """
+    Плоская строка (короткие имена, пути через точку) -> вложенный конфиг.
+    Вложенные объекты JSONL остаются как есть; пустые ячейки CSV пропускаются.
+    """
+    config = {}
+    for name, value in row.items():
+        if name is None:
+            raise ValueError(f"лишние ячейки в строке: {value}")
+        if from_csv:
+            if value is None or value == '':
+                continue
+            value = _cell(_key_path(name), value)
+        path = _key_path(name)
+        node = config
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    return config
+
+
+def iter_records(path):
+    """
+    (id строки, конфиг-словарь | None, ошибка | None) по одной, лениво.
+    id — "<файл>:<номер строки>"; битая строка не останавливает остальные.
+    Формат — по расширению: .csv, иначе JSONL (пустые строки и # — пропускаются).
+    """
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield _record(f"{path}:{reader.line_num}", row, from_csv=True)
+        return
+
+    with open(path, encoding='utf-8') as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield f"{path}:{line_num}", None, f"{type(e).__name__}: {e}"
+                continue
+            yield _record(f"{path}:{line_num}", row)
+
+
+def _record(row_id, row, from_csv=False):
+    try:
+        if not isinstance(row, dict):
+            raise ValueError("ожидался JSON-объект")
+        return row_id, row_to_config(row, from_csv), None
+    except (ValueError, TypeError) as e:
+        return row_id, None, f"{type(e).__name__}: {e}"
@@ -0,0 +1,130 @@
+"""
+memory.py — бюджет памяти для пакетного рендера и замер пикового RSS.
+
+Оценку памяти карточки считает run.estimate_card_memory по заголовкам картинок;
+здесь — то, что от карточек не зависит: допуск задач под бюджет, замер
+настоящего пика (Linux: /proc/self/clear_refs + VmHWM) и журнал «оценка / факт»,
+по которому оценку можно подкрутить.
+"""
+import json
+import os
+import threading
+
+# Байт на пиксель по режимам Pillow (в памяти, а не в файле)
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 4, 'PA': 4, 'RGB': 4, 'RGBA': 4, 'RGBX': 4, 'CMYK': 4,
+              'YCbCr': 4, 'LAB': 4, 'HSV': 4, 'I': 4, 'F': 4, 'I;16': 2, 'I;16B': 2, 'I;16L': 2}
+
+MEMORY_LOG = 'tmp/card_memory.json'
+# Как часто ожидающий acquire проверяет stop, секунды
+_POLL = 0.1
+
+
+def image_bytes(size, mode='RGB'):
+    """Сколько занимает декодированная картинка size в режиме mode."""
+    return size[0] * size[1] * MODE_BYTES.get(mode, 4)
+
+
+def available_memory():
+    """MemAvailable из /proc/meminfo в байтах; None, если узнать нельзя."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _status_bytes(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Сбрасывает пик RSS процесса (VmHWM) до текущего RSS и возвращает текущий RSS.
+    None, если не Linux или ядро не даёт сбросить.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return _status_bytes('VmRSS')
+
+
+def peak_rss():
+    """Пик RSS процесса с последнего reset_peak_rss (или с запуска)."""
+    return _status_bytes('VmHWM')
+
+
+class MemoryBudget:
+    """
+    Допуск задач под бюджет байт: acquire(n) ждёт, пока занятое + n влезет.
+    Задача, которая одна больше бюджета, всё равно пускается, когда занятых нет, —
+    иначе сборка бы повисла.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.running = 0
+        self._cond = threading.Condition()
+
+    def fits(self, n):
+        return self.limit is None or self.running == 0 or self.used + n <= self.limit
+
+    def acquire(self, n, stop=None):
+        """
+        Занимает n байт, дождавшись места. stop — threading.Event: если его
+        выставили, пока ждём, ничего не занимаем и возвращаем False.
+        """
+        with self._cond:
+            while not self.fits(n):
+                if stop is not None and stop.is_set():
+                    return False
+                self._cond.wait(_POLL if stop is not None else None)
+            self.used += n
+            self.running += 1
+        return True
+
+    def release(self, n):
+        with self._cond:
+            self.used -= n
+            self.running -= 1
+            self._cond.notify_all()
+
+
+class MemoryLog:
+    """Журнал по карточкам: оценка памяти и фактический пик RSS (байты)."""
+
+    def __init__(self, path=MEMORY_LOG):
+        self.path = path
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.cards = json.load(f)
+        except (OSError, ValueError):
+            self.cards = {}
+
+    def record(self, config_name, estimate, peak=None, base=None):
+        """Без peak прошлый замер остаётся — его не с чем заменить."""
+        entry = dict(self.cards.get(config_name, {}), estimate=estimate)
+        if peak is not None:
+            entry['peak_rss'] = peak
+            if base is not None:
+                entry['peak_delta'] = peak - base
+        self.cards[config_name] = entry
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.cards, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
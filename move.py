@@ -1,55 +1,153 @@
-
 #!/usr/bin/env python3
+"""
+move.py — сдвиг изображения на dx/dy пикселей с дублированием края
+(для выравнивания сканов).
+
+Сдвиг делается средствами Pillow в одном выходном буфере: crop со смещением
+сразу кладёт пиксели на новое место, освободившаяся полоса заполняется
+повтором крайнего столбца/строки. Режим не меняется — палитра (P), 16 бит
+(I;16), альфа и прочее остаются как были, без промежуточного NumPy-массива;
+в JPEG, который палитру и альфу не держит, результат конвертируется в RGB.
+
+Примеры:
+  python move.py scan.png fixed.png               # вправо на 12 px, как раньше
+  python move.py scan.png fixed.png --dx -3 --dy 5
+  python move.py scan.png fixed.png --up 4         # только вверх (dx = 0)
+  python move.py scans/ fixed/ --jobs 4           # папка, пул процессов
+"""
 import argparse
-from pathlib import Path
+import os
+import time
 from PIL import Image
-import numpy as np
 
-def process_image(input_path: str, output_path: str, move_size=4):
-    img = Image.open(input_path)
-    arr = np.array(img)
+from utils import ordered_map
+
+DEFAULT_DX = 12
+IMAGE_EXTS = {'.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif', '.webp'}
+# Что из img.info переносим в сохранённый файл
+KEEP_INFO = ('transparency', 'icc_profile', 'exif', 'dpi')
+# Форматы, которые хранят прозрачность через info['transparency'] (палитра/цветовой ключ)
+TRANSPARENCY_FORMATS = {'PNG', 'GIF'}
+# Режимы, которые JPEG пишет как есть; остальные (P, RGBA, LA, I;16...) — через конвертацию
+JPEG_MODES = {'1', 'L', 'RGB', 'CMYK'}
+
+
+def shift_image(img: Image.Image, dx: int = 0, dy: int = 0) -> Image.Image:
+    """
+    Сдвигает содержимое на dx вправо (отрицательный — влево) и dy вниз
+    (отрицательный — вверх); освободившиеся полосы — копия края.
+    Возвращает новое изображение того же режима (палитра сохраняется).
+    """
+    w, h = img.size
+    if abs(dx) >= w or abs(dy) >= h:
+        raise ValueError(f"Сдвиг ({dx}, {dy}) не меньше размера изображения {w}x{h}.")
 
-    # Ожидаем 2D (L) или 3D (RGB/RGBA)
-    if arr.ndim == 2:
-        h, w = arr.shape
-        channels = None
-    elif arr.ndim == 3:
-        h, w, channels = arr.shape
-    else:
-        raise ValueError("Неподдерживаемый формат изображения.")
+    # один буфер результата: всё, что вышло за край исходника, — пока нули
+    out = img.crop((-dx, -dy, w - dx, h - dy))
 
-    if w < 5:
-        raise ValueError("Ширина изображения должна быть ≥ 5 пикселей.")
+    # края — после сдвига по x, чтобы углы при сдвиге по обеим осям тоже заполнились
+    if dx:
+        col = dx if dx > 0 else w + dx - 1
+        edge = out.crop((col, 0, col + 1, h)).resize((abs(dx), h), Image.Resampling.NEAREST)
+        out.paste(edge, (0 if dx > 0 else w + dx, 0))
+    if dy:
+        row = dy if dy > 0 else h + dy - 1
+        edge = out.crop((0, row, w, row + 1)).resize((w, abs(dy)), Image.Resampling.NEAREST)
+        out.paste(edge, (0, 0 if dy > 0 else h + dy))
+    return out
 
-    # 1) Обрезаем справа 4 пикселя
-    cropped = arr[:, :w-move_size] if channels is None else arr[:, :w-move_size, :]
 
-    # 2) Дублируем левый столбец и добавляем 4 пикселя слева
-    if channels is None:
-        left_col = cropped[:, :1]
-    else:
-        left_col = cropped[:, :1, :]
+def prepare_save(out: Image.Image, info: dict, output_path: str):
+    """
+    Режим и параметры сохранения под формат output_path: (изображение, kwargs).
+    Режим сохраняется, если формат его держит; в JPEG палитра и альфа уходят
+    через конвертацию (LA -> L, прочее -> RGB), как в старой версии. Ключи
+    KEEP_INFO, которых формат не поддерживает, отбрасываются.
+    """
+    fmt = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+    save_kwargs = {k: info[k] for k in KEEP_INFO if k in info}
+    if fmt == 'JPEG' and out.mode not in JPEG_MODES:
+        out = out.convert('L' if out.mode == 'LA' else 'RGB')
+    if fmt not in TRANSPARENCY_FORMATS:
+        save_kwargs.pop('transparency', None)
+    if fmt is None and out.mode == 'P':
+        # расширение неизвестно — палитру сохраняем как PNG (как раньше)
+        save_kwargs['format'] = 'PNG'
+    return out, save_kwargs
 
-    pad_left = np.repeat(left_col, move_size, axis=1)
-    out_arr = np.concatenate([pad_left, cropped], axis=1)
 
-    # Приводим обратно к изображению
-    out_img = Image.fromarray(out_arr)
-    # Если исходное было палитровым (P), мы уже потеряли палитру; сохраняем как PNG.
-    save_kwargs = {}
-    if img.mode == "P":
-        save_kwargs["format"] = "PNG"
+def process_image(input_path: str, output_path: str, move_size=4, dy=0):
+    """Сдвигает файл на move_size вправо (dx) и dy вниз и сохраняет в том же режиме (если формат позволяет)."""
+    with Image.open(input_path) as img:
+        out, save_kwargs = prepare_save(shift_image(img, move_size, dy), img.info, output_path)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    out.save(output_path, **save_kwargs)
 
-    out_img.save(output_path, **save_kwargs)
+
+def _process_task(task):
+    """Задача для пула: (inp, out, dx, dy) -> (inp, out, ошибка | None)."""
+    inp, out_path, dx, dy = task
+    try:
+        process_image(inp, out_path, dx, dy)
+        return inp, out_path, None
+    except Exception as e:
+        return inp, out_path, f"{type(e).__name__}: {e}"
+
+
+def iter_tasks(input_dir, output_dir, dx, dy, recursive=False):
+    """Задачи по файлам папки — лениво, список целиком не строится."""
+    for dirpath, _, filenames in os.walk(input_dir):
+        for f in sorted(filenames):
+            if os.path.splitext(f)[1].lower() not in IMAGE_EXTS:
+                continue
+            inp = os.path.join(dirpath, f)
+            yield inp, os.path.join(output_dir, os.path.relpath(inp, input_dir)), dx, dy
+        if not recursive:
+            break
+
+
+def process_batch(tasks, jobs=1):
+    """Задачи через пул процессов (utils.ordered_map): (inp, out, ошибка) в порядке входа."""
+    return ordered_map(_process_task, tasks, max(jobs, 1))
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Обрезать справа на 4px и продублировать слева 4px (edge).")
-    parser.add_argument("input", help="Входной файл изображения")
-    parser.add_argument("output", help="Выходной файл")
+    parser = argparse.ArgumentParser(description="Сдвинуть изображение на dx/dy пикселей, продублировав край.")
+    parser.add_argument("input", help="Входной файл или папка")
+    parser.add_argument("output", help="Выходной файл или папка")
+    parser.add_argument("--dx", type=int, default=DEFAULT_DX,
+                        help=f"сдвиг вправо, px (отрицательный — влево; по умолчанию {DEFAULT_DX})")
+    parser.add_argument("--dy", type=int, default=0, help="сдвиг вниз, px (отрицательный — вверх)")
+    for name, help_ in (("left", "влево"), ("right", "вправо"), ("up", "вверх"), ("down", "вниз")):
+        parser.add_argument(f"--{name}", type=int, metavar="N", help=f"сдвиг {help_} на N px (вместо --dx/--dy)")
+    parser.add_argument("--jobs", type=int, default=1, help="число процессов для папки")
+    parser.add_argument("--recursive", action="store_true", help="рекурсивно обрабатывать папки")
     args = parser.parse_args()
+    if any(v is not None for v in (args.left, args.right, args.up, args.down)):
+        args.dx = (args.right or 0) - (args.left or 0)
+        args.dy = (args.down or 0) - (args.up or 0)
+
+    if os.path.isfile(args.input):
+        process_image(args.input, args.output, args.dx, args.dy)
+        return
+    if not os.path.isdir(args.input):
+        parser.error(f"нет такого файла или папки: {args.input}")
 
-    process_image(args.input, args.output, 12)
+    started = time.perf_counter()
+    done = failed = 0
+    for inp, out_path, error in process_batch(iter_tasks(args.input, args.output, args.dx, args.dy,
+                                                         args.recursive), args.jobs):
+        if error is None:
+            done += 1
+            print(f"OK: {inp} -> {out_path}")
+        else:
+            failed += 1
+            print(f"FAIL: {inp} ({error})")
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"Готово: {done} ок, {failed} ошибок за {elapsed:.1f} с ({rate:.2f} изобр./с)")
+    if failed:
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+"""
+pdfwriter.py — потоковая запись многостраничного PDF.
+
+Страницы кодируются и пишутся в файл по одной: в памяти держится только текущая,
+так что пиковое потребление не растёт ни с числом карточек, ни с числом страниц.
+Файл пишется во временный <path>.part и переименовывается при close(), поэтому
+прерванная сборка не оставляет битый PDF под настоящим именем.
+
+Пример:
+  with PdfStreamWriter('tmp/all.pdf', dpi=600) as pdf:
+      for page in pages:
+          pdf.add_image_page(page)
+"""
+import io
+import os
+from collections import namedtuple
+
+from aspectfit import transpose_matrix
+
+# Уже закодированная картинка для страницы: JPEG-байты (DCTDecode) и её габариты.
+# Кортеж дешёвый и пиклится — его можно отдавать из воркеров пула.
+EncodedImage = namedtuple('EncodedImage', 'data width height colorspace')
+
+# Картинка, уложенная на страницу геометрией PDF, без растрового листа:
+# page_size — (w, h) страницы в пикселях, box — (x, y, w, h) картинки на ней
+# (от левого верхнего угла), transpose — Image.Transpose, применяемые по порядку.
+PlacedImage = namedtuple('PlacedImage', 'image page_size box transpose')
+
+_COLORSPACES = {'RGB': '/DeviceRGB', 'L': '/DeviceGray'}
+
+
+def encode_image(img, quality=None):
+    """
+    Кодирует PIL.Image в JPEG для вставки в PDF. quality=None — как у Pillow
+    при save(format='PDF'), т.е. умолчание libjpeg.
+    """
+    if img.mode not in _COLORSPACES:
+        img = img.convert('RGB')
+    buf = io.BytesIO()
+    save_kwargs = {} if quality is None else {'quality': quality}
+    img.save(buf, 'JPEG', **save_kwargs)
+    return EncodedImage(buf.getvalue(), img.width, img.height, _COLORSPACES[img.mode])
+
+
+def encode_page(page, quality=None):
+    """Страница из iter_pages в пиклящийся вид: PIL.Image кодируется, PlacedImage — как есть."""
+    if isinstance(page, PlacedImage):
+        return page
+    return PlacedImage(encode_image(page, quality), None, None, ())
+
+
+def _placement_matrix(x, y, w, h, transpose):
+    """
+    Матрица cm, которая кладёт картинку (единичный квадрат в пространстве
+    изображения PDF) в прямоугольник (x, y, w, h) страницы с учётом transpose.
+    """
+    a1, b1, c1, a2, b2, c2 = transpose_matrix(transpose)
+    # в PDF u = s, v = 1 - t, а ось Y страницы смотрит вверх
+    return (w * a1, -h * a2, -w * b1, h * b2, x + w * (b1 + c1), y + h * (1 - b2 - c2))
+
+
+def _num(x):
+    return f"{x:.4f}".rstrip('0').rstrip('.')
+
+
+class PdfStreamWriter:
+    def __init__(self, path, dpi, quality=None):
+        self.path = path
+        self.dpi = dpi
+        self.quality = quality
+        self.pages = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._tmp_path = path + '.part'
+        self._f = open(self._tmp_path, 'wb')
+        self._offsets = {}
+        self._page_ids = []
+        # 1 — Catalog, 2 — Pages: пишем в конце, когда известен список страниц
+        self._next_id = 3
+        self._f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_image_page(self, img):
+        """Страница размером с img (при self.dpi), картинка на весь лист."""
+        self.add_encoded_page(encode_image(img, self.quality))
+
+    def add_page(self, page):
+        """Страница из iter_pages: PIL.Image или PlacedImage."""
+        if isinstance(page, PlacedImage):
+            self.add_encoded_page(*page)
+        else:
+            self.add_image_page(page)
+
+    def add_encoded_page(self, image, page_size=None, box=None, transpose=()):
+        """
+        Страница из уже закодированной картинки.
+
+        Args:
+            image: EncodedImage
+            page_size: (w, h) страницы в пикселях при self.dpi; по умолчанию — размер картинки
+            box: (x, y, w, h) картинки на странице в пикселях от левого верхнего угла;
+                 по умолчанию — на весь лист
+            transpose: Image.Transpose, которые надо применить к картинке по порядку —
+                       поворот делается матрицей, без перекодирования
+        """
+        if page_size is None:
+            page_size = (image.width, image.height)
+            if transpose_matrix(transpose)[0] == 0:
+                page_size = page_size[::-1]
+        if box is None:
+            box = (0, 0) + tuple(page_size)
+        k = 72.0 / self.dpi
+        page_w, page_h = page_size[0] * k, page_size[1] * k
+        x, y, w, h = box[0] * k, (page_size[1] - box[1] - box[3]) * k, box[2] * k, box[3] * k
+        matrix = _placement_matrix(x, y, w, h, transpose)
+        self._add_page(image, page_w, page_h, matrix)
+
+    def _add_page(self, image, page_w, page_h, matrix):
+        image_id = self._write_stream(
+            f"/Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} "
+            f"/ColorSpace {image.colorspace} /BitsPerComponent 8 /Filter /DCTDecode",
+            image.data,
+        )
+        content = f"q {' '.join(_num(v) for v in matrix)} cm /Im0 Do Q".encode('ascii')
+        content_id = self._write_stream('', content)
+        page_id = self._write_object(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {_num(page_w)} {_num(page_h)}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>".encode('ascii')
+        )
+        self._page_ids.append(page_id)
+        self.pages += 1
+
+    def _write_object(self, body, obj_id=None):
+        if obj_id is None:
+            obj_id = self._next_id
+            self._next_id += 1
+        self._offsets[obj_id] = self._f.tell()
+        self._f.write(f"{obj_id} 0 obj\n".encode('ascii'))
+        self._f.write(body)
+        self._f.write(b"\nendobj\n")
+        return obj_id
+
+    def _write_stream(self, entries, data):
+        head = f"<< {entries} /Length {len(data)} >>\nstream\n".encode('ascii')
+        return self._write_object(head + data + b"\nendstream")
+
+    def close(self):
+        if self._f is None:
+            return
+        kids = ' '.join(f"{i} 0 R" for i in self._page_ids)
+        self._write_object(f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>".encode('ascii'), 2)
+        self._write_object(b"<< /Type /Catalog /Pages 2 0 R >>", 1)
+
+        xref_offset = self._f.tell()
+        size = self._next_id
+        self._f.write(f"xref\n0 {size}\n0000000000 65535 f \n".encode('ascii'))
+        for obj_id in range(1, size):
+            self._f.write(f"{self._offsets[obj_id]:010d} 00000 n \n".encode('ascii'))
+        self._f.write(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode('ascii'))
+        self._f.close()
+        self._f = None
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Закрыть без результата: недописанный файл удаляется."""
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        os.remove(self._tmp_path)
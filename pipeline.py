@@ -0,0 +1,113 @@
+"""
+pipeline.py — конвейер из стадий на потоках с ограниченными очередями.
+
+Элемент проходит стадии по очереди, у каждой стадии свой пул потоков, между
+стадиями — очередь на maxsize элементов. Пока одна карточка кодируется в PDF,
+следующая уже декодируется: Pillow отпускает GIL на декоде, ресэмпле и
+кодировании, так что один процесс занимает несколько ядер, а в памяти
+одновременно не больше нескольких карточек на стадию.
+
+Пример:
+  stages = [Stage('decode', decode, 2), Stage('encode', encode, 2)]
+  for item, result, error in run_pipeline(items, stages):
+      ...
+"""
+import queue
+import threading
+from collections import namedtuple
+
+# fn(value) -> value для следующей стадии; threads — размер пула стадии
+Stage = namedtuple('Stage', 'name fn threads')
+
+_DONE = object()
+_POLL = 0.1
+
+
+def _put(q, item, stop):
+    """put, который не виснет навсегда, если потребитель ушёл."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def run_pipeline(items, stages, maxsize=None, stop=None):
+    """
+    Прогоняет items через stages и отдаёт (item, result, error) по мере готовности
+    (порядок не гарантирован). Исключение на стадии не останавливает конвейер:
+    элемент проходит остальные стадии транзитом с error = "Тип: текст".
+
+    Args:
+        items: итерируемое входов первой стадии (читается лениво)
+        stages: список Stage
+        maxsize: ёмкость очереди перед каждой стадией (по умолчанию — потоки стадии)
+        stop: threading.Event, который конвейер выставит при завершении или
+            прерывании, — чтобы items, ждущий чего-то, тоже мог выйти
+    """
+    stop = stop or threading.Event()
+    queues = [queue.Queue(maxsize or stage.threads) for stage in stages]
+    queues.append(queue.Queue())  # выход: его читает вызывающий, он не копится
+    threads = []
+
+    def feed():
+        for item in items:
+            if not _put(queues[0], (item, item, None), stop):
+                return
+        for _ in range(stages[0].threads):
+            _put(queues[0], _DONE, stop)
+
+    def work(i, stage, remaining, lock):
+        src, dst = queues[i], queues[i + 1]
+        while True:
+            task = _get(src, stop)
+            if task is _DONE:
+                break
+            item, value, error = task
+            if error is None:
+                try:
+                    value = stage.fn(value)
+                except Exception as e:
+                    value, error = None, f"{type(e).__name__}: {e}"
+            if not _put(dst, (item, value, error), stop):
+                return
+        # последний поток стадии закрывает следующую
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            n = stages[i + 1].threads if i + 1 < len(stages) else 1
+            for _ in range(n):
+                _put(dst, _DONE, stop)
+
+    threads.append(threading.Thread(target=feed, name='pipeline-feed', daemon=True))
+    for i, stage in enumerate(stages):
+        remaining, lock = [stage.threads], threading.Lock()
+        for k in range(stage.threads):
+            threads.append(threading.Thread(target=work, args=(i, stage, remaining, lock),
+                                            name=f'pipeline-{stage.name}-{k}', daemon=True))
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            task = queues[-1].get()
+            if task is _DONE:
+                break
+            yield task
+    finally:
+        # при прерывании потребителем потоки сами выйдут по stop
+        stop.set()
+        for t in threads:
+            t.join()
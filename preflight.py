@@ -0,0 +1,187 @@
+"""
+preflight.py — быстрая проверка карточек до пакетного рендера (run.py --check).
+
+Без декода пикселей: конфиги разрешаются с parent, у фото и слоёв читаются
+только заголовки (размер, режим, EXIF-ориентация), шрифты — проверяются на
+наличие. Находит то, на чём рендер упал бы (или тихо подменил шрифт) через
+минуты после старта: нет фото/слоя/шрифта, неизвестный gravity, две карточки
+в один файл. Предупреждает о фото, которые на этом dpi придётся растягивать.
+
+По каждой карточке печатается план: куда пишется, фото, эффективный dpi и
+оценка памяти (estimate_card_memory). Заголовки кэшируются на проход —
+общий слой родителя читается один раз, тысячи карточек проверяются за секунды.
+"""
+import os
+import time
+from collections import namedtuple
+from typing import get_args
+
+from PIL import Image
+
+from aspectfit import Gravity, exif_orientation
+from run import (TEXT_FIELDS, estimate_card_memory, load_config, output_path_for, page_sizes,
+                 photo_info, render_settings)
+
+GRAVITIES = get_args(Gravity)
+# Фото растягивается сильнее — предупреждение (эффективный dpi ниже такой доли от целевого)
+MIN_DPI_SHARE = 0.9
+
+Header = namedtuple('Header', 'size mode format orientation')
+# План карточки: errors — рендер упадёт, warnings — отрендерится, но стоит посмотреть
+# (photo — Header с размером уже после поворота и EXIF)
+CardPlan = namedtuple('CardPlan', 'card output errors warnings photo effective_dpi memory')
+
+
+def read_header(path, headers):
+    """Header картинки по заголовку (пиксели не декодируются); headers — кэш прохода."""
+    header = headers.get(path)
+    if header is None:
+        with Image.open(path) as img:
+            header = Header(img.size, img.mode, img.format, exif_orientation(img))
+        headers[path] = header
+    return header
+
+
+def oriented(header, rotate=0):
+    """Размер после поворота и EXIF (как run.oriented_size); None — угол не кратен 90."""
+    if rotate % 90:
+        return None
+    w, h = header.size
+    if rotate % 180:
+        w, h = h, w
+    if header.orientation in (5, 6, 7, 8):
+        w, h = h, w
+    return w, h
+
+
+def effective_dpi(size, image_size, dpi):
+    """С каким dpi фото size ляжет на страницу image_size (aspect_fit: обрезка до пропорций)."""
+    scale = max(image_size[0] / size[0], image_size[1] / size[1])
+    return dpi / scale
+
+
+def _check_file(path, what, errors):
+    if not path:
+        errors.append(f"{what}: путь не задан")
+        return False
+    if not os.path.exists(path):
+        errors.append(f"{what}: нет файла {path}")
+        return False
+    return True
+
+
+def check_card(card, config_name, overrides=None, headers=None):
+    """
+    Проверяет одну карточку; config_name — путь к JSON или inline-конфиг.
+    Никогда не падает: всё найденное — в errors/warnings плана.
+    """
+    headers = {} if headers is None else headers
+    errors, warnings = [], []
+    output = photo = dpi = memory = None
+    try:
+        config = load_config(config_name)
+        settings = render_settings(config, overrides)
+        output = output_path_for(config, settings)
+    except Exception as e:
+        return CardPlan(card, None, [f"конфиг: {type(e).__name__}: {e}"], [], None, None, None)
+
+    image_size, _ = page_sizes(settings.dpi)
+    try:
+        info = photo_info(config)
+    except (KeyError, TypeError) as e:
+        errors.append(f"image: нет ключа {e}")
+        info = None
+    if info is not None:
+        if info['gravity'] not in GRAVITIES:
+            errors.append(f"image.gravity: {info['gravity']!r} (есть: {', '.join(GRAVITIES)})")
+        if not isinstance(info['rotate'], int):
+            errors.append(f"image.rotate: {info['rotate']!r} — нужно целое число градусов")
+        elif _check_file(info['path'], 'фото', errors):
+            try:
+                header = read_header(info['path'], headers)
+            except Exception as e:
+                errors.append(f"фото не читается: {info['path']} ({type(e).__name__}: {e})")
+            else:
+                size = oriented(header, info['rotate']) or header.size
+                photo = header._replace(size=size)
+                dpi = effective_dpi(size, image_size, settings.dpi)
+                if dpi < settings.dpi * MIN_DPI_SHARE:
+                    warnings.append(f"фото мало: {size[0]}x{size[1]} при {image_size[0]}x{image_size[1]} "
+                                    f"нужных — выйдет {dpi:.0f} dpi вместо {settings.dpi}")
+
+    layout_path = config.get('layout', {}).get('path')
+    if _check_file(layout_path, 'слой', errors):
+        try:
+            read_header(layout_path, headers)
+        except Exception as e:
+            errors.append(f"слой не читается: {layout_path} ({type(e).__name__}: {e})")
+
+    for field in TEXT_FIELDS:
+        info = config.get(field)
+        if info is None:
+            errors.append(f"{field}: нет в конфиге")
+            continue
+        position = info.get('position')
+        if not isinstance(position, (list, tuple)) or len(position) < 2:
+            errors.append(f"{field}.position: {position!r} — нужно (x, y) или (x, y, w, h)")
+        # без шрифта draw_text молча рисует встроенным
+        _check_file(info.get('font'), f"{field}: шрифт", errors)
+
+    if not errors:
+        try:
+            memory = estimate_card_memory(config_name, overrides)
+        except Exception as e:
+            warnings.append(f"оценка памяти: {type(e).__name__}: {e}")
+    return CardPlan(card, output, errors, warnings, photo, dpi, memory)
+
+
+def preflight(items, overrides=None):
+    """
+    Проверяет карточки и печатает план; items — (имя, путь или inline-конфиг,
+    ошибка чтения | None), как у bulk.iter_records. Идёт потоково: в памяти
+    только кэш заголовков и занятые пути результатов.
+
+    Returns:
+        (сколько карточек, сколько с ошибками)
+    """
+    started = time.perf_counter()
+    headers = {}
+    outputs = {}  # путь результата -> первая карточка с ним
+    total = failed = warned = 0
+    memory_total = memory_max = 0
+    for card, config_name, error in items:
+        total += 1
+        if error is not None:
+            plan = CardPlan(card, None, [error], [], None, None, None)
+        else:
+            plan = check_card(card, config_name, overrides, headers)
+        if plan.output is not None:
+            key = os.path.normpath(plan.output)
+            if key in outputs:
+                plan.errors.append(f"тот же результат, что у {outputs[key]}: {plan.output}")
+            else:
+                outputs[key] = card
+
+        if plan.errors:
+            failed += 1
+            print(f"FAIL: {card} ({'; '.join(plan.errors)})")
+        else:
+            details = []
+            if plan.photo is not None:
+                details.append(f"фото {plan.photo.size[0]}x{plan.photo.size[1]} {plan.photo.mode}, "
+                               f"{plan.effective_dpi:.0f} dpi")
+            if plan.memory is not None:
+                details.append(f"память ~{plan.memory / 2 ** 20:.0f} МБ")
+                memory_total += plan.memory
+                memory_max = max(memory_max, plan.memory)
+            print(f"OK: {card} -> {plan.output} ({', '.join(details)})")
+        if plan.warnings:
+            warned += 1
+            for warning in plan.warnings:
+                print(f"WARN: {card}: {warning}")
+
+    elapsed = time.perf_counter() - started
+    print(f"Готово: проверено {total}, ошибок: {failed}, с предупреждениями: {warned}; "
+          f"память: всего ~{memory_total / 2 ** 20:.0f} МБ, максимум на карточку ~{memory_max / 2 ** 20:.0f} МБ "
+          f"({elapsed:.2f} с)")
+    return total, failed
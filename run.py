@@ -1,103 +1,516 @@
+import argparse
+import glob
+import math
 import os
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 from PIL import Image, ImageDraw, ImageFont
-from utils import deep_merge, read_json
-from aspectfit import to_aspect, parse_aspect
+from utils import config_dependencies, mtime_ns, ordered_map, read_config, resolve_config, resolve_inline_config
+from assets import (
+    PHOTO_CACHE_BYTES, content_digest, find_photo, get_font, get_layer, get_layout, get_text_bbox, get_text_length,
+    photo_cache_enabled, put_photo, set_photo_disk_cache, set_photo_memory_limit,
+)
+from buildstate import BuildManifest
+from bulk import iter_records
+from memory import MEMORY_LOG, MemoryBudget, MemoryLog, available_memory, image_bytes, peak_rss, reset_peak_rss
+from pipeline import Stage, run_pipeline
+import tracing
+from tracing import note, span
+from watch import watch
+from pdfwriter import EncodedImage, PdfStreamWriter, PlacedImage, encode_page
+from aspectfit import (
+    _apply_exif_orientation, apply_fit_plan, aspect_layout, exif_orientation, orientation_ops, parse_aspect,
+    plan_fit, to_aspect,
+)
 
 CARD_WIDTH = 146+2
 CARD_HEIGHT = 105+2
+DPI = 600
 
-def draw_text(draw, text, position, font_name=None, font_size=None, fill=(0, 0, 0, 255)):
-    # position: (x, y) или (x, y, w, h) — лишнее игнорим
+# Не уменьшаем PNG и прочие не-JPEG при декоде сильнее, чем до REDUCE_GAP × целевого
+# размера: дальше финальный LANCZOS досчитывает качественно
+REDUCE_GAP = 2
+# Исходный JPEG встраиваем в PDF как есть, только если он не больше чем в столько
+# раз крупнее нужного: иначе пересжатие до 600 dpi заметно уменьшает файл
+PASSTHROUGH_MAX_SCALE = 2
+
+# Карточки по умолчанию: cards/1.json, cards/2.json, ... (global*.json — только родители)
+DEFAULT_CONFIGS = ['cards/[0-9]*.json']
+# Хэши входов уже собранных PDF — для инкрементальной сборки
+BUILD_MANIFEST = 'tmp/build_manifest.json'
+
+# Настройки рендера: финальная печать и быстрый предпросмотр. Карточка может
+# переопределить их ключом "render" ({"preview": true, "dpi": 100, ...}),
+# а запуск — флагами --preview/--dpi/--resample/--format (они главнее).
+RenderSettings = namedtuple('RenderSettings', 'dpi resample format preview')
+FINAL_SETTINGS = RenderSettings(dpi=DPI, resample='lanczos', format='pdf', preview=False)
+PREVIEW_SETTINGS = RenderSettings(dpi=120, resample='bilinear', format='jpeg', preview=True)
+RESAMPLERS = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'hamming': Image.Resampling.HAMMING,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+OUTPUT_FORMATS = {'pdf': '.pdf', 'png': '.png', 'jpeg': '.jpg'}
+THUMBNAIL_GAP = 16
+
+# Шрифты из кэша общие на процесс, а рисовать одним FreeType-шрифтом из
+# нескольких потоков сразу нельзя (конвейер, сервер) — текст рисуется по очереди
+_text_lock = threading.Lock()
+
+# Бюджет памяти по умолчанию — такая доля MemAvailable на момент запуска
+MEMORY_BUDGET_SHARE = 0.8
+
+TEXT_FIELDS = ('username_info', 'cardname_info')
+TEXT_FONT_SIZES = {'username_info': 45, 'cardname_info': 60}
+# Меньше этого кегля текст под рамку не ужимается (и вылезает — см. note 'text_overflow')
+MIN_FONT_SIZE = 12
+
+def draw_text(draw, text, position, font_name=None, font_size=None, fill=(0, 0, 0, 255), wrap=False):
+    # position: (x, y) или (x, y, w, h); с рамкой кегль подбирается так, чтобы
+    # текст влез в w×h (font_size — наибольший), wrap — переносить по словам
     if not isinstance(position, (list, tuple)) or len(position) < 2:
         raise TypeError("position должен быть (x, y) или (x, y, w, h)")
     x, y = position[0], position[1]
+    box = tuple(position[2:4]) if len(position) >= 4 else None
 
-    # шрифт: либо truetype, либо дефолт
-    if font_name is None or not os.path.exists(font_name):
-        print(f"{font_name}: not found, path not exist")
-        font = ImageFont.load_default()
-    else:
+    # шрифт: либо truetype (из кэша), либо дефолт
+    font = None
+    if font_name is not None:
         if font_size is None:
             font_size = int(W * 0.06)  # хочешь — переопредели
-        font = ImageFont.truetype(font_name, font_size)
+        try:
+            font = get_font(font_name, font_size)
+        except FileNotFoundError:
+            pass
+    if font is None:
+        print(f"{font_name}: not found, path not exist")
+        font = ImageFont.load_default()
+        box = None  # у встроенного шрифта нет кеглей
+
+    with _text_lock:
+        if box is None:
+            draw.text((x, y), text, font=font, fill=fill)
+            return {"pos": (x, y), "font_size": getattr(font, "size", None)}
 
-    draw.text((x, y), text, font=font, fill=fill)
-    return {"pos": (x, y), "font_size": getattr(font, "size", None)}
+        with span('fit_text'):
+            font_size, lines, fits = fit_text(font_name, text, box, font_size, wrap)
+        if not fits:
+            note('text_overflow', {'text': text, 'box': list(box), 'font_size': font_size})
+        font = get_font(font_name, font_size)
+        ascent, descent = font.getmetrics()
+        for i, line in enumerate(lines):
+            draw.text((x, y + i * (ascent + descent)), line, font=font, fill=fill)
+    return {"pos": (x, y), "font_size": font_size, "lines": lines}
 
 
-def images_to_pdf(images, output_pdf_path):
+def line_width(font_name, font_size, line):
     """
-    Конвертирует два изображения в PDF с размером страниц 104x146 мм
-    
-    Args:
-        image1_path: путь к первому изображению
-        image2_path: путь к второму изображению  
-        output_pdf_path: путь для сохранения PDF файла
+    Ширина строки по advance как сумма ширин слов и пробелов: слова повторяются
+    между названиями и кеглями, так что почти все размеры берутся из кэша.
     """
-    
+    words = line.split(' ')
+    space = get_text_length(font_name, font_size, ' ')
+    return sum(get_text_length(font_name, font_size, word) for word in words) + space * (len(words) - 1)
+
+
+def wrap_lines(font_name, font_size, text, max_width):
+    """Перенос по словам: строки не шире max_width (слово длиннее — одно на строке)."""
+    space = get_text_length(font_name, font_size, ' ')
+    lines = []
+    for paragraph in text.split('\n'):
+        line, width = [], 0
+        for word in paragraph.split():
+            word_width = get_text_length(font_name, font_size, word)
+            if line and width + space + word_width > max_width:
+                lines.append(' '.join(line))
+                line, width = [], 0
+            width += (space if line else 0) + word_width
+            line.append(word)
+        lines.append(' '.join(line))
+    return lines
+
+
+def text_extent(font_name, font_size, text, max_width, wrap=False, exact=False):
+    """
+    (строки, ширина, высота) текста кеглем font_size — только по метрикам, без
+    отрисовки. Ширина — по advance (line_width); exact — по настоящим границам
+    глифов (get_text_bbox, курсив выступает за advance), это дороже.
+    """
+    lines = wrap_lines(font_name, font_size, text, max_width) if wrap else text.split('\n')
+    ascent, descent = get_font(font_name, font_size).getmetrics()
+    if exact:
+        width = max(get_text_bbox(font_name, font_size, line)[2] for line in lines)
+    else:
+        width = max(line_width(font_name, font_size, line) for line in lines)
+    return lines, width, len(lines) * (ascent + descent)
+
+
+def fit_text(font_name, text, box, max_size, wrap=False):
+    """
+    Наибольший кегль от MIN_FONT_SIZE (или max_size, если он меньше) до max_size,
+    при котором текст влезает в box (w, h). Кегль ищется двоичным поиском по
+    ширинам слов из кэша, найденный проверяется по настоящим границам строк
+    и при нужде уменьшается.
+    Возвращает (кегль, строки, влез ли); не влез и на минимуме — минимум.
+    """
+    box_w, box_h = box
+    # кегль из конфига меньше минимума — минимумом становится он сам, крупнее не берём
+    min_size = min(MIN_FONT_SIZE, max_size)
+
+    def fits(size, exact=False):
+        lines, width, height = text_extent(font_name, size, text, box_w, wrap, exact)
+        return lines if width <= box_w and height <= box_h else None
+
+    # обычно название влезает и так — двоичный поиск не нужен
+    size = max_size
+    if fits(size) is None:
+        lo, hi = min_size, max_size - 1
+        size = None
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if fits(mid) is not None:
+                size, lo = mid, mid + 1
+            else:
+                hi = mid - 1
+        if size is None:
+            return min_size, text_extent(font_name, min_size, text, box_w, wrap)[0], False
+
+    while True:
+        lines = fits(size, exact=True)
+        if lines is not None:
+            return size, lines, True
+        if size <= min_size:
+            return size, text_extent(font_name, size, text, box_w, wrap)[0], False
+        size -= 1
+
+
+def page_sizes(dpi=DPI):
+    """(ширина, высота) картинки и (ширина, высота) страницы в пикселях при dpi."""
     # Размеры страницы в мм
     page_width_mm = CARD_WIDTH+2
     page_height_mm = CARD_HEIGHT+2
-    
-    # Конвертируем мм в пиксели (300 DPI для высокого качества печати)
-    dpi = 600
+
+    # Конвертируем мм в пиксели
     image_width_px = int(CARD_WIDTH * dpi / 25.4)
     image_height_px = int(CARD_HEIGHT * dpi / 25.4)
     page_width_px = int(page_width_mm * dpi / 25.4)
     page_height_px = int(page_height_mm * dpi / 25.4)
-    
-    print(f"Размер страницы в пикселях: {page_width_px}x{page_height_px}")
-    
-    # Список для хранения обработанных изображений
-    images_for_pdf = []
-    
+    return (image_width_px, image_height_px), (page_width_px, page_height_px)
+
+
+def iter_pages(images, passthrough=True, dpi=DPI, resample=Image.Resampling.LANCZOS):
+    """
+    Страницы для PDF по одной: каждое изображение подгоняется под размер
+    и центрируется на белом листе. Следующая страница создаётся только когда
+    предыдущая уже отдана — в памяти держится одна.
+
+    Фото-JPEG, которому не нужны ни обрезка, ни поля, отдаётся как PlacedImage:
+    исходные байты без декода, поворот и масштаб — геометрией страницы PDF.
+    """
+    image_size, page_size = page_sizes(dpi)
+    (image_width_px, image_height_px), (page_width_px, page_height_px) = image_size, page_size
+    note('page_px', [page_width_px, page_height_px])
+
     # Обрабатываем каждое изображение
-    for i, img_info in enumerate(images, 1):
+    for img_info in images:
+        placed = None
+        if passthrough:
+            with span('passthrough'):
+                placed = passthrough_page(img_info, image_size, page_size)
+        if placed is not None:
+            note('passthrough', img_info['path'])
+            yield placed
+            continue
+
+        yield place_on_page(fitted_image(img_info, image_size, resample), page_size)
+
+
+def place_on_page(img, page_size):
+    """Белая страница page_size с img по центру."""
+    page_width_px, page_height_px = page_size
+    with span('compose'):
+        # Создаем белую страницу нужного размера
+        page = Image.new('RGB', (page_width_px, page_height_px), 'white')
+
+        # Центрируем изображение на странице
+        x_offset = (page_width_px - img.width) // 2
+        y_offset = (page_height_px - img.height) // 2
+        page.paste(img, (x_offset, y_offset))
+    return page
+
+
+def images_to_pdf(images, output_pdf_path, dpi=DPI, resample=Image.Resampling.LANCZOS):
+    """
+    Конвертирует изображения в PDF, по странице на изображение
+
+    Args:
+        images: список dict-ов; источник — 'image' (готовый PIL.Image)
+                или 'path' (путь к файлу), плюс 'adoptation', 'gravity', 'rotate'
+        output_pdf_path: путь для сохранения PDF файла
+        dpi, resample: разрешение страниц и фильтр ресайза
+    """
+    # Страницы кодируются и пишутся сразу, не копясь в памяти
+    with PdfStreamWriter(output_pdf_path, dpi) as pdf:
+        for page in iter_pages(images, dpi=dpi, resample=resample):
+            with span('encode'):
+                pdf.add_page(page)
+
+
+def images_to_thumbnail(images, output_path, dpi, resample=Image.Resampling.BILINEAR):
+    """
+    Страницы карточки одной картинкой (PNG/JPEG — по расширению) рядом
+    друг с другом — для быстрого просмотра вместо PDF.
+    """
+    write_thumbnail(list(iter_pages(images, passthrough=False, dpi=dpi, resample=resample)), output_path)
+
+
+def write_thumbnail(pages, output_path):
+    width = sum(page.width for page in pages) + THUMBNAIL_GAP * (len(pages) - 1)
+    sheet = Image.new('RGB', (width, max(page.height for page in pages)), 'white')
+    x = 0
+    for page in pages:
+        sheet.paste(page, (x, 0))
+        x += page.width + THUMBNAIL_GAP
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    # пишем во временный файл рядом — недописанная картинка не останется под настоящим именем
+    root, ext = os.path.splitext(output_path)
+    tmp_path = root + '.part' + ext
+    with span('encode'):
+        if ext.lower() in ('.jpg', '.jpeg'):
+            sheet.save(tmp_path, quality=85)
+        else:
+            sheet.save(tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+def passthrough_page(img_info, image_size, page_size):
+    """
+    PlacedImage из исходного JPEG, если фото ложится на страницу без изменения
+    пикселей: после поворота и EXIF соотношение сторон уже как у страницы (to_aspect
+    ничего не режет и не добавляет), а поворот кратен 90°. Иначе None.
+    """
+    img_path = img_info.get('path')
+    if img_info.get('image') is not None or img_info['adoptation'] == 'fit' or not img_path:
+        return None
+    if not os.path.exists(img_path):
+        return None
+
+    with Image.open(img_path) as img:
+        if img.format != 'JPEG' or img.mode not in ('RGB', 'L'):
+            return None
+        rotate = img_info.get('rotate', 0)
+        size = oriented_size(img, rotate)
+        if size is None:
+            return None
+        crop_box, canvas_size, _ = aspect_layout(size, image_size[0] / image_size[1],
+                                                 crop_gravity=img_info['gravity'])
+        if crop_box != (0, 0) + tuple(size) or tuple(canvas_size) != tuple(size):
+            return None
+        if size[1] > PASSTHROUGH_MAX_SCALE * image_size[1]:
+            return None
+        transpose = orientation_ops(rotate, exif_orientation(img))
+        width, height = img.size
+        colorspace = '/DeviceRGB' if img.mode == 'RGB' else '/DeviceGray'
+
+    with open(img_path, 'rb') as f:
+        data = f.read()
+    box = ((page_size[0] - image_size[0]) // 2, (page_size[1] - image_size[1]) // 2) + tuple(image_size)
+    return PlacedImage(EncodedImage(data, width, height, colorspace), tuple(page_size), box, tuple(transpose))
+
+
+def photo_cache_key(img_info, image_size, resample):
+    """
+    Ключ обработанного фото для assets.find_photo/put_photo: содержимое файла и всё, от
+    чего зависит результат prepare_image (подгонка, gravity, поворот, размер
+    под dpi, фильтр). None — кэшировать нечего (кэш выключен, картинка в памяти
+    или файла нет).
+    """
+    if not photo_cache_enabled():
+        return None
+    img_path = img_info.get('path')
+    if img_info.get('image') is not None or not img_path or not os.path.exists(img_path):
+        return None
+    return ('photo', content_digest(img_path), img_info['adoptation'], img_info.get('gravity'),
+            img_info.get('rotate', 0), tuple(image_size), int(resample))
+
+
+def fitted_image(img_info, image_size, resample=Image.Resampling.LANCZOS):
+    """prepare_image через кэш обработанных фото: повтор фото не декодируется заново."""
+    key = photo_cache_key(img_info, image_size, resample)
+    if key is None:
+        return prepare_image(img_info, *image_size, resample=resample)
+    with span('photo_cache'):
+        img = find_photo(key)
+    if img is not None:
+        note('photo_cache', img_info['path'])
+        return img
+    img = prepare_image(img_info, *image_size, resample=resample)
+    put_photo(key, img)
+    return img
+
+
+# Декодированное фото и всё, что нужно для его подгонки (см. decode_image):
+# plan — aspectfit.FitPlan или None, src_size — размер до уменьшенного декода,
+# full_size — полный размер после поворота, если поля считаются по нему.
+DecodedImage = namedtuple('DecodedImage', 'image plan src_size full_size')
+
+
+def prepare_image(img_info, image_width_px, image_height_px, draft=True, resample=Image.Resampling.LANCZOS):
+    """
+    Открывает изображение из img_info и подгоняет его под размер страницы.
+
+    Для фото (adoptation != 'fit') при draft=True по заголовку строится план
+    (aspectfit.plan_fit): поворот, EXIF, обрезка и ресайз сводятся к одной обрезке
+    с одним ресэмплом по исходным пикселям, а картинка декодируется сразу
+    уменьшенной (JPEG draft / Image.reduce). draft=False — прежний пошаговый путь.
+    """
+    decoded = decode_image(img_info, image_width_px, image_height_px, draft)
+    return transform_image(decoded, img_info, image_width_px, image_height_px, resample)
+
+
+def decode_image(img_info, image_width_px, image_height_px, draft=True):
+    """Первая половина prepare_image: открыть и декодировать (уменьшенным, если можно)."""
+    img = img_info.get('image')
+    plan = src_size = full_size = None
+    if img is None:
         img_path = img_info['path']
         if not os.path.exists(img_path):
             raise FileNotFoundError(f"Изображение не найдено: {img_path}")
-            
-        # Открываем изображение
-        img = Image.open(img_path)
-        print(f"Изображение {i}: {img.size}, режим: {img.mode}")
-        
-        # Конвертируем в RGB если необходимо (для PDF)
-        if img.mode != 'RGB':
+
+        with span('decode'):
+            # Открываем изображение
+            img = Image.open(img_path)
+            if draft and img_info['adoptation'] != 'fit':
+                rotate = img_info.get('rotate', 0)
+                plan = plan_fit(img.size, (image_width_px, image_height_px), rotate, exif_orientation(img),
+                                crop_gravity=img_info["gravity"])
+                if plan is not None:
+                    src_size = img.size
+                    box_w, box_h = plan.box[2] - plan.box[0], plan.box[3] - plan.box[1]
+                    img = reduce_for_scale(img, max(plan.size[0] / box_w, plan.size[1] / box_h))
+                else:
+                    # нужны поля — идём пошагово, но тоже с уменьшенным декодом
+                    size = oriented_size(img, rotate)
+                    if size is not None:
+                        img = reduce_for_scale(img, image_height_px / size[1])
+                        # декодировали уменьшенным — поля считаем по полному размеру
+                        if oriented_size(img, rotate) != size:
+                            full_size = size
+            img.load()
+        note('decode', {'path': img_path, 'size': list(img.size), 'mode': img.mode,
+                        'full_size': list(src_size or full_size or img.size)})
+    return DecodedImage(img, plan, src_size, full_size)
+
+
+def transform_image(decoded, img_info, image_width_px, image_height_px, resample=Image.Resampling.LANCZOS):
+    """Вторая половина prepare_image: поворот, обрезка/поля и ресайз под страницу."""
+    img, plan, full_size = decoded.image, decoded.plan, decoded.full_size
+    if plan is not None:
+        img_resized = apply_fit_plan(img, plan, decoded.src_size, resample)
+        note('resized', list(img_resized.size))
+        return img_resized
+
+    # Конвертируем в RGB если необходимо (для PDF)
+    if img.mode != 'RGB':
+        with span('convert'):
             img = img.convert('RGB')
 
-        if 'rotate' in img_info:
-            rotate_angle = img_info.get('rotate', 0)
+    if 'rotate' in img_info:
+        rotate_angle = img_info.get('rotate', 0)
+        with span('rotate'):
             img = img.rotate(rotate_angle, expand=True)
-        
-        if img_info['adoptation'] == 'fit':
-            # Изменяем размер изображения под страницу, сохраняя пропорции
-            img_resized = resize_image_to_fit(img, image_width_px, image_height_px)
-        else:
-            img_resized = resize_image_to_exact(img, image_width_px, image_height_px, gravity=img_info["gravity"])
-            print("Ресайзнутое изображение:", img_resized.size)
-        # Создаем белую страницу нужного размера
-        page = Image.new('RGB', (page_width_px, page_height_px), 'white')
-        
-        # Центрируем изображение на странице
-        x_offset = (page_width_px - img_resized.width) // 2
-        y_offset = (page_height_px - img_resized.height) // 2
-        page.paste(img_resized, (x_offset, y_offset))
-        
-        images_for_pdf.append(page)
-    
-    # Сохраняем в PDF
-    images_for_pdf[0].save(
-        output_pdf_path,
-        save_all=True,
-        append_images=images_for_pdf[1:],
-        resolution=dpi,
-        format='PDF'
-    )
-    
-    print(f"PDF успешно создан: {output_pdf_path}")
 
-def resize_image_to_fit(img, target_width, target_height):
+    if img_info['adoptation'] == 'fit':
+        # Изменяем размер изображения под страницу, сохраняя пропорции
+        with span('resize'):
+            return resize_image_to_fit(img, image_width_px, image_height_px, resample)
+
+    img_resized = resize_image_to_exact(img, image_width_px, image_height_px, gravity=img_info["gravity"],
+                                        full_size=full_size, resample=resample)
+    note('resized', list(img_resized.size))
+    return img_resized
+
+
+def oriented_size(img, rotate=0):
+    """
+    Размер изображения после поворота на rotate и EXIF-ориентации — по заголовку.
+    None, если угол не кратен 90 (expand меняет габариты).
+    """
+    if rotate % 90:
+        return None
+    W, H = img.size
+    if rotate % 180:
+        W, H = H, W
+    # to_aspect применяет EXIF-ориентацию уже после поворота
+    if exif_orientation(img) in (5, 6, 7, 8):
+        W, H = H, W
+    return W, H
+
+
+def reduce_for_scale(img, scale):
+    """
+    Уменьшает ещё не декодированное изображение не сильнее, чем в 1/scale раз:
+    после этого финальный ресэмпл всё ещё не увеличивает картинку.
+    """
+    if scale >= 1:
+        return img
+
+    if img.format == 'JPEG':
+        # libjpeg декодирует сразу в 1/2, 1/4 или 1/8 — не меньше запрошенного
+        img.draft(None, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        return img
+
+    factor = int(1 / (scale * REDUCE_GAP))
+    if factor >= 2 and img.mode in ('L', 'LA', 'RGB', 'RGBA'):
+        return img.reduce(factor)
+    return img
+
+
+def reduced_size(img, scale):
+    """
+    Размер, до которого reduce_for_scale уменьшит img, — без декода.
+    JPEG переводится в draft (это только заголовок), остальное считается.
+    """
+    if scale >= 1:
+        return img.size
+    if img.format == 'JPEG':
+        return reduce_for_scale(img, scale).size
+    factor = int(1 / (scale * REDUCE_GAP))
+    if factor >= 2 and img.mode in ('L', 'LA', 'RGB', 'RGBA'):
+        return math.ceil(img.width / factor), math.ceil(img.height / factor)
+    return img.size
+
+
+def photo_memory(img_info, image_size, page_size):
+    """
+    Пик памяти страницы с фото в байтах по заголовку (см. prepare_image):
+    декод (уже уменьшенный), результат ресэмпла, его копия после поворота и лист.
+    """
+    target = image_bytes(image_size)
+    page = image_bytes(page_size)
+    with Image.open(img_info['path']) as img:
+        rotate = img_info.get('rotate', 0)
+        plan = plan_fit(img.size, image_size, rotate, exif_orientation(img), crop_gravity=img_info['gravity'])
+        if plan is not None:
+            box_w, box_h = plan.box[2] - plan.box[0], plan.box[3] - plan.box[1]
+            decoded = image_bytes(reduced_size(img, max(plan.size[0] / box_w, plan.size[1] / box_h)), img.mode)
+            return decoded + 2 * target + page
+        size = oriented_size(img, rotate)
+        if size is None:
+            # произвольный угол: полный декод, RGB-копия и повёрнутая с expand (до 2× по площади)
+            decoded = image_bytes(img.size, img.mode)
+            return decoded + 3 * image_bytes(img.size) + target + page
+        reduced = reduced_size(img, image_size[1] / size[1])
+        # плюс RGB-копия, прозрачный RGBA-холст с полями и ресайз
+        return image_bytes(reduced, img.mode) + 2 * image_bytes(reduced) + target + page
+
+
+def resize_image_to_fit(img, target_width, target_height, resample=Image.Resampling.LANCZOS):
     """
     Изменяет размер изображения, сохраняя пропорции и вписывая в заданные размеры
     """
@@ -114,85 +527,777 @@ def resize_image_to_fit(img, target_width, target_height):
     
     # Изменяем размер с высоким качеством
     # Для фотографий используем LANCZOS, для черно-белой графики - NEAREST или LANCZOS
-    return img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    return img.resize((new_width, new_height), resample)
 
 # Альтернативная функция для точного соответствия размеру (с обрезкой)
-def resize_image_to_exact(img, target_width, target_height, gravity):
+def resize_image_to_exact(img, target_width, target_height, gravity, full_size=None,
+                          resample=Image.Resampling.LANCZOS):
     """
     Изменяет размер изображения точно под заданные размеры (может обрезать края)
+
+    full_size — размер исходника (после поворота и EXIF), если img декодирован
+    уменьшенным: поля тогда считаем по полному размеру и переносим в координаты
+    уменьшенного кадра, чтобы результат совпадал с полным декодом до долей пикселя.
+    (Случай «только обрезка» сюда не доходит — его целиком делает apply_fit_plan.)
     """
-    img = to_aspect(img, aspect=parse_aspect(f"{target_width}:{target_height}"), crop_gravity=gravity)
-    print("Обрезанное изображение:", img.size)
-    return img.resize((target_width, target_height), Image.Resampling.LANCZOS)
+    if full_size is not None:
+        with span('exif'):
+            img = _apply_exif_orientation(img)
+        sx = img.width / full_size[0]
+        sy = img.height / full_size[1]
+        crop_box, canvas_size, paste_xy = aspect_layout(full_size, target_width / target_height, crop_gravity=gravity)
+        if crop_box == (0, 0) + tuple(full_size):
+            # только поля (как в to_aspect — прозрачные): кладём кадр на целый пиксель,
+            # а дробный сдвиг отдаём в box, чтобы поля легли там же, где при полном декоде
+            px, py = paste_xy[0] * sx, paste_xy[1] * sy
+            ix, iy = math.ceil(px), math.ceil(py)
+            box = (ix - px, iy - py, ix - px + canvas_size[0] * sx, iy - py + canvas_size[1] * sy)
+            with span('crop'):
+                canvas = Image.new('RGBA', (math.ceil(box[2]), math.ceil(box[3])), (0, 0, 0, 0))
+                canvas.paste(img.convert('RGBA'), (ix, iy))
+            note('cropped', list(canvas_size))
+            with span('resize'):
+                return canvas.resize((target_width, target_height), resample, box=box)
+    # to_aspect: EXIF-ориентация, обрезка и поля одним вызовом
+    with span('crop'):
+        img = to_aspect(img, aspect=parse_aspect(f"{target_width}:{target_height}"), crop_gravity=gravity)
+    note('cropped', list(img.size))
+    with span('resize'):
+        return img.resize((target_width, target_height), resample)
     # return img
 
-# Пример использования
-def process_card(config_name):
-    config = read_json(config_name)
+def layer_path_for(output_pdf):
+    """Путь промежуточного слоя с текстом — свой для каждой карточки."""
+    return os.path.splitext(output_pdf)[0] + '.layer.png'
 
-    if "parent" in config:
-        parent_config = read_json(config["parent"])
-        config = deep_merge(parent_config, config)
 
+def load_config(config_name):
+    """Итоговый конфиг карточки: путь к JSON или уже разобранный dict (inline)."""
+    if isinstance(config_name, dict):
+        return resolve_inline_config(config_name)
+    return resolve_config(config_name)
 
-    background_path = config['layout']['path']
 
-    # Open image
-    img = Image.open(background_path).convert("RGBA")
-    W, H = img.size
+def render_settings(config=None, overrides=None):
+    """
+    Настройки рендера карточки: умолчания уровня (финал или предпросмотр),
+    поверх — "render" из конфига, поверх — overrides запуска (dict с теми же
+    ключами, None-значения не считаются). "preview" выбирает умолчания уровня;
+    если запуск выбрал другой уровень, чем карточка, её "render" не действует.
+    """
+    card = dict((config or {}).get('render', {}))
+    run = {k: v for k, v in (overrides or {}).items() if v is not None}
+    preview = run.get('preview', card.get('preview', False))
+    if preview != card.get('preview', False):
+        # запуск сменил уровень — настройки карточки были для другого
+        card = {}
+    settings = (PREVIEW_SETTINGS if preview else FINAL_SETTINGS)._asdict()
+    settings.update(card)
+    settings.update(run)
+    settings['preview'] = bool(preview)
+    settings['dpi'] = int(settings['dpi'])
+    settings['resample'] = str(settings['resample']).lower()
+    settings['format'] = str(settings['format']).lower()
+    if settings['resample'] not in RESAMPLERS:
+        raise ValueError(f"Неизвестный resample: {settings['resample']} (есть: {', '.join(RESAMPLERS)})")
+    if settings['format'] not in OUTPUT_FORMATS:
+        raise ValueError(f"Неизвестный format: {settings['format']} (есть: {', '.join(OUTPUT_FORMATS)})")
+    return RenderSettings(**{k: settings[k] for k in RenderSettings._fields})
 
-    draw = ImageDraw.Draw(img)
 
-    draw_text(
-        draw,
-        text=config['username_info']['content'],
-        position=config['username_info']["position"],
-        font_name=config['username_info']['font'],
-        font_size=45,
-    )
+def output_path_for(config, settings):
+    """
+    Куда писать результат: финальный PDF — в output_pdf как раньше, остальное —
+    рядом с ним (<имя>.png, превью — <имя>.preview.<ext>), чтобы не затирать печать.
+    """
+    output_pdf = config['output_pdf']
+    if not settings.preview and settings.format == 'pdf':
+        return output_pdf
+    suffix = '.preview' if settings.preview else ''
+    return os.path.splitext(output_pdf)[0] + suffix + OUTPUT_FORMATS[settings.format]
+
+
+def card_files(config):
+    """Файлы, которые рендер карточки читает: фото, слой и шрифты."""
+    files = [config['image']['path'], config['layout']['path']]
+    files += [config[field]['font'] for field in TEXT_FIELDS if config.get(field, {}).get('font')]
+    return files
+
+
+def card_dependencies(config_name):
+    """Всё, от чего зависит карточка: её JSON, цепочка parent и card_files."""
+    return config_dependencies(config_name) + card_files(load_config(config_name))
+
+
+def card_inputs_digest(manifest, config_name, overrides=None):
+    """
+    (путь результата, хэш всех входов карточки) — итоговый конфиг, фото, слой,
+    шрифты, константы и настройки рендера. Падает, если конфига или какого-то файла нет.
+    """
+    config = load_config(config_name)
+    settings = render_settings(config, overrides)
+    files = card_files(config)
+    constants = {'CARD_WIDTH': CARD_WIDTH, 'CARD_HEIGHT': CARD_HEIGHT, 'render': settings._asdict()}
+    return output_path_for(config, settings), manifest.inputs_digest(config, files, constants)
+
+
+def shared_text_fields(config_name):
+    """
+    Текстовые поля, которые карточка целиком берёт у родителей, — их можно
+    нарисовать один раз на общий слой. Только префикс TEXT_FIELDS, чтобы
+    порядок отрисовки (и наложения) остался прежним.
+    """
+    own = config_name if isinstance(config_name, dict) else read_config(config_name)
+    shared = []
+    for field in TEXT_FIELDS:
+        if field in own:
+            break
+        shared.append(field)
+    return tuple(shared)
+
 
+def _draw_field(draw, config, field):
+    # "font_size" — кегль (с рамкой в position — наибольший), "wrap" — перенос под рамку
+    info = config[field]
     draw_text(
         draw,
-        text=config['cardname_info']['content'],
-        position=config['cardname_info']["position"],
-        font_name=config['cardname_info']['font'],
-        font_size=60,
+        text=info['content'],
+        position=info["position"],
+        font_name=info['font'],
+        font_size=info.get('font_size', TEXT_FONT_SIZES[field]),
+        wrap=info.get('wrap', False),
     )
-    
-    # сохраняем итог в файл
-    out_path = "tmp/card.png"
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    img.save(out_path)
 
-    print("saved tmp image:", out_path)
 
+def base_layer(config, shared_fields=()):
+    """
+    Слой с текстом общих полей. Кэшируется на процесс по содержимому (слой,
+    тексты, шрифты и их mtime), так что у всех карточек одного родителя
+    он рисуется один раз; каждая карточка получает свою копию.
+    """
+    background_path = config['layout']['path']
+    if not shared_fields:
+        return get_layout(background_path)
+
+    key = ('base', background_path, mtime_ns(background_path))
+    for field in shared_fields:
+        info = config[field]
+        key += ((field, info['content'], tuple(info['position']), info['font'], mtime_ns(info['font']),
+                 info.get('font_size', TEXT_FONT_SIZES[field]), info.get('wrap', False)),)
+
+    def build():
+        img = get_layout(background_path)
+        draw = ImageDraw.Draw(img)
+        for field in shared_fields:
+            _draw_field(draw, config, field)
+        return img
+
+    return get_layer(key, build)
+
+
+def estimate_card_memory(config_name, overrides=None):
+    """
+    Оценка пика памяти на рендер карточки в байтах — только по заголовкам
+    картинок, без декода. Слой RGBA живёт всю карточку; страницы делаются по
+    очереди, так что к нему добавляется большая из двух. Базовая память
+    интерпретатора сюда не входит. Фактические пики пишутся в MemoryLog.
+    """
+    config = load_config(config_name)
+    image_size, page_size = page_sizes(render_settings(config, overrides).dpi)
+    with Image.open(config['layout']['path']) as layout:
+        layout_size = layout.size
+    # RGB-копия, поворот, ресайз под страницу и лист
+    layer_page = 2 * image_bytes(layout_size) + image_bytes(image_size) + image_bytes(page_size)
+    photo_page = photo_memory(photo_info(config), image_size, page_size)
+    return image_bytes(layout_size, 'RGBA') + max(photo_page, layer_page)
+
+
+def photo_cache_limit(configs, overrides=None):
+    """
+    Сколько памяти дать кэшу обработанных фото на пакет: по странице на каждое
+    фото, которое пакет подгоняет одинаково больше одного раза (не больше
+    PHOTO_CACHE_BYTES); 0 — повторов нет, кэш в памяти ничего не даст.
+    """
+    seen, repeated = set(), set()
+    for config_name in configs:
+        try:
+            config = load_config(config_name)
+            settings = render_settings(config, overrides)
+            photo = photo_info(config)
+        except Exception:
+            continue  # упадёт при рендере
+        key = (photo['path'], photo['gravity'], photo['rotate'], settings.dpi, settings.resample)
+        (repeated if key in seen else seen).add(key)
+    total = sum(image_bytes(page_sizes(key[3])[0]) for key in repeated)
+    return min(total, PHOTO_CACHE_BYTES)
+
+
+def card_images(config, save_layer=False, shared_fields=()):
+    """
+    Рисует текст на слое карточки и возвращает описания страниц для
+    iter_pages / images_to_pdf: фото и слой. Поля из shared_fields берутся
+    с общего закэшированного слоя (см. shared_text_fields), остальные
+    рисуются для карточки.
+    """
+    return [photo_info(config), layer_info(config, save_layer, shared_fields)]
+
+
+def photo_info(config):
+    """Описание страницы с фото для iter_pages."""
     # Укажите пути к вашим изображениям
     photo_path = config['image']['path']
-    layout_path = out_path
-    output_path = config['output_pdf']
-    
+
+    return {
+        'path': photo_path,
+        'adoptation': 'aspect_fit',
+        "gravity": config['image'].get("gravity", "center"),
+        "rotate": config['image'].get('rotate', 0)
+    }
+
+
+def layer_info(config, save_layer=False, shared_fields=()):
+    """Слой с текстом карточки — описание страницы для iter_pages."""
+    with span('layout'):
+        img = base_layer(config, shared_fields)
+    with span('text'):
+        draw = ImageDraw.Draw(img)
+        for field in TEXT_FIELDS:
+            if field not in shared_fields:
+                _draw_field(draw, config, field)
+
+    # промежуточный слой на диск — только для отладки, в PDF он идёт из памяти
+    if save_layer:
+        layer_path = layer_path_for(config['output_pdf'])
+        os.makedirs(os.path.dirname(layer_path) or '.', exist_ok=True)
+        img.save(layer_path)
+        print("saved layer image:", layer_path)
+
+    return {
+        'image': img,
+        'adoptation': 'fit',
+        "rotate": config['layout'].get('rotate', 0)
+    }
+
+
+# Пример использования
+def process_card(config_name, save_layer=False, overrides=None, output_path=None):
+    """
+    Рендерит карточку и возвращает путь результата. config_name — путь к JSON
+    или inline-конфиг (dict, "parent" разрешается как у файла); output_path —
+    куда писать вместо пути из конфига.
+    """
+    with tracing.card(config_name):
+        with span('config'):
+            config = load_config(config_name)
+            settings = render_settings(config, overrides)
+        output_path = output_path or output_path_for(config, settings)
+        images = card_images(config, save_layer, shared_text_fields(config_name))
+        if settings.format == 'pdf':
+            images_to_pdf(images, output_path, settings.dpi, RESAMPLERS[settings.resample])
+        else:
+            images_to_thumbnail(images, output_path, settings.dpi, RESAMPLERS[settings.resample])
+        note('output', output_path)
+    return output_path
+
+
+def card_stages(save_layer=False, threads=2, overrides=None):
+    """
+    Стадии конвейера (pipeline.run_pipeline) для карточек в одном процессе:
+    чтение и декод фото -> подгонка фото -> слой с текстом -> кодирование и запись.
+    Вход — путь к конфигу, выход — путь к результату. Стадия с текстом — в один
+    поток: общие шрифты FreeType нельзя рисовать из нескольких потоков сразу.
+    Трейс карточки (tracing) переходит между стадиями вместе с ней.
+    """
+    def traced(fn):
+        def stage(job):
+            with tracing.resume(job['trace']):
+                try:
+                    return fn(job)
+                except Exception as e:
+                    if job['trace'] is not None:
+                        job['trace']['error'] = f"{type(e).__name__}: {e}"
+                        tracing.finish(job['trace'])
+                    raise
+        return stage
+
+    def start(config_name):
+        trace = tracing.new_record(config_name) if tracing.enabled() else None
+        return {'config_name': config_name, 'trace': trace, 'decoded': None, 'photo_key': None, 'pages': []}
+
+    @traced
+    def decode(job):
+        with span('config'):
+            config = load_config(job['config_name'])
+            settings = render_settings(config, overrides)
+        image_size, page_size = page_sizes(settings.dpi)
+        photo = photo_info(config)
+        job.update(config=config, settings=settings, photo=photo, image_size=image_size, page_size=page_size)
+        placed = None
+        if settings.format == 'pdf':
+            with span('passthrough'):
+                placed = passthrough_page(photo, image_size, page_size)
+        if placed is not None:
+            note('passthrough', photo['path'])
+            job['pages'].append(placed)
+            return job
+        job['photo_key'] = photo_cache_key(photo, image_size, RESAMPLERS[settings.resample])
+        if job['photo_key'] is not None:
+            with span('photo_cache'):
+                cached = find_photo(job['photo_key'])
+            if cached is not None:
+                note('photo_cache', photo['path'])
+                job['pages'].append(place_on_page(cached, page_size))
+                return job
+        job['decoded'] = decode_image(photo, *image_size)
+        return job
+
+    @traced
+    def transform(job):
+        if job['decoded'] is not None:
+            img = transform_image(job['decoded'], job['photo'], *job['image_size'],
+                                  RESAMPLERS[job['settings'].resample])
+            job['decoded'] = None
+            if job['photo_key'] is not None:
+                put_photo(job['photo_key'], img)
+            job['pages'].append(place_on_page(img, job['page_size']))
+        return job
+
+    @traced
+    def composite(job):
+        layer = layer_info(job['config'], save_layer, shared_text_fields(job['config_name']))
+        img = prepare_image(layer, *job['image_size'], resample=RESAMPLERS[job['settings'].resample])
+        job['pages'].append(place_on_page(img, job['page_size']))
+        return job
+
+    @traced
+    def write(job):
+        settings = job['settings']
+        output_path = output_path_for(job['config'], settings)
+        if settings.format != 'pdf':
+            write_thumbnail(job['pages'], output_path)
+        else:
+            with PdfStreamWriter(output_path, settings.dpi) as pdf:
+                for page in job['pages']:
+                    with span('encode'):
+                        pdf.add_page(page)
+        tracing.finish(job['trace'], output_path)
+        return output_path
+
+    return [
+        Stage('start', start, 1),
+        Stage('decode', decode, threads),
+        Stage('transform', transform, threads),
+        Stage('composite', composite, 1),
+        Stage('write', write, threads),
+    ]
+
+
+def expand_configs(patterns):
+    """
+    Раскрывает глобы в список путей к конфигам (без повторов, порядок сохраняется).
+    Путь без совпадений остаётся как есть — пусть упадёт и попадёт в отчёт.
+    """
+    out = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if path not in seen:
+                seen.add(path)
+                out.append(path)
+    return out
+
+
+def render_card(config_name, save_layer=False, overrides=None):
+    """
+    Рендер одной карточки для пакетного режима: исключения не пробрасываются,
+    а возвращаются в результате — (config_name, output_pdf | None, error | None).
+    """
     try:
-        images_to_pdf(
-            [
-                {
-                    'path': photo_path,
-                    'adoptation': 'aspect_fit',
-                    "gravity": config['image'].get("gravity", "center"),
-                    "rotate": config['image'].get('rotate', 0)
-                },
-                {
-                    'path': layout_path,
-                    'adoptation': 'fit',
-                    "rotate": config['layout'].get('rotate', 0)
-                },
-            ], 
-            output_path,
-        )
+        return config_name, process_card(config_name, save_layer=save_layer, overrides=overrides), None
+    except Exception as e:
+        return config_name, None, f"{type(e).__name__}: {e}"
+
+
+def render_card_measured(config_name, save_layer=False, overrides=None):
+    """
+    render_card с замером пика RSS: (результат render_card, пик, RSS до старта) — байты или None.
+    """
+    base = reset_peak_rss()
+    result = render_card(config_name, save_layer, overrides)
+    return result, (peak_rss() if base is not None else None), base
+
+
+def default_memory_budget():
+    available = available_memory()
+    return int(available * MEMORY_BUDGET_SHARE) if available else None
+
+
+def _mb(n):
+    return f"{n / 2 ** 20:.0f} МБ"
+
+
+def render_batch(configs, workers=None, save_layer=False, manifest_path=BUILD_MANIFEST, force=False,
+                 threads=None, memory_budget=None, memory_log=MEMORY_LOG, overrides=None):
+    """
+    Рендерит карточки на пуле процессов (или конвейером на потоках — threads)
+    и печатает OK/FAIL по каждой.
+
+    Карточки, чьи входы не изменились с прошлой сборки (см. buildstate), пропускаются.
+    Одновременно рендерятся только карточки, чьи оценки памяти (estimate_card_memory)
+    вместе влезают в memory_budget; фактический пик RSS каждой пишется в memory_log.
+    Кэш обработанных фото в памяти включается, только если фото в пакете
+    повторяются (photo_cache_limit), и его лимит добавляется к оценке каждой
+    карточки — у каждого процесса пула кэш свой.
+
+    Args:
+        configs: пути к конфигам карточек
+        workers: число процессов (None — по числу ядер, 1 — без пула)
+        save_layer: сохранять ли слой с текстом рядом с PDF (отладка)
+        manifest_path: файл манифеста сборки (None — без инкрементальности)
+        force: пересобрать всё, не глядя в манифест
+        threads: если задано — вместо пула процессов один процесс с конвейером
+                 стадий (см. card_stages), по threads потоков на стадию
+        memory_budget: байт на все одновременно рендерящиеся карточки (None — без лимита)
+        memory_log: файл журнала «оценка / пик RSS» (None — не писать); в режиме
+                    threads пик на карточку не отделить, пишется только оценка
+        overrides: настройки рендера на весь запуск (см. render_settings)
+
+    Returns:
+        список (config_name, output_pdf, error) в порядке configs
+    """
+    configs = list(configs)
+    results = {}
+    manifest = BuildManifest(manifest_path) if manifest_path else None
+    digests = {}
+
+    todo = []
+    for config_name in configs:
+        if manifest is not None:
+            try:
+                output_pdf, digest = card_inputs_digest(manifest, config_name, overrides)
+            except Exception:
+                # чего-то не хватает — пусть рендер упадёт и попадёт в отчёт
+                todo.append(config_name)
+                continue
+            digests[config_name] = (output_pdf, digest)
+            if not force and manifest.is_fresh(output_pdf, digest):
+                results[config_name] = (config_name, output_pdf, None)
+                print(f"SKIP: {config_name} -> {output_pdf} (не изменилась)")
+                continue
+        todo.append(config_name)
+
+    photo_cache = photo_cache_limit(todo, overrides)
+    set_photo_memory_limit(photo_cache)
+    estimates = {}
+    for config_name in todo:
+        try:
+            estimates[config_name] = estimate_card_memory(config_name, overrides) + photo_cache
+        except Exception:
+            estimates[config_name] = 0  # упадёт сразу, памяти не займёт
+    budget = MemoryBudget(memory_budget)
+    log = MemoryLog(memory_log) if memory_log else None
+
+    def report(result, peak=None, base=None):
+        config_name, output_pdf, error = result
+        results[config_name] = result
+        if log is not None:
+            log.record(config_name, estimates[config_name], peak, base)
+        if error is None:
+            memory = f"память: оценка {_mb(estimates[config_name])}"
+            if peak is not None and base is not None:
+                memory += f", пик +{_mb(peak - base)}"
+            print(f"OK: {config_name} -> {output_pdf} ({memory})")
+            if config_name in digests:
+                manifest.record(*digests[config_name])
+        else:
+            print(f"FAIL: {config_name} ({error})")
+
+    stop = threading.Event()
+
+    def admitted():
+        # без stop поток подачи ждал бы release вечно, если потребитель прервался
+        for config_name in todo:
+            if not budget.acquire(estimates[config_name], stop):
+                return
+            yield config_name
+
+    try:
+        if threads:
+            for result in run_pipeline(admitted(), card_stages(save_layer, threads, overrides), stop=stop):
+                budget.release(estimates[result[0]])
+                report(result)
+        elif workers == 1 or len(todo) <= 1:
+            for config_name in todo:
+                report(*render_card_measured(config_name, save_layer, overrides))
+        else:
+            max_running = workers or os.cpu_count() or 1
+            waiting = deque(todo)
+            running = {}
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                while waiting or running:
+                    # пускаем, пока есть свободный процесс и оценка влезает в бюджет
+                    while (waiting and len(running) < max_running
+                           and budget.fits(estimates[waiting[0]])):
+                        config_name = waiting.popleft()
+                        budget.acquire(estimates[config_name])
+                        running[executor.submit(render_card_measured, config_name, save_layer, overrides)] = config_name
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        budget.release(estimates[running.pop(future)])
+                        report(*future.result())
+    finally:
+        # даже при прерывании сохраняем то, что успели собрать
+        if manifest is not None:
+            manifest.save()
+        if log is not None:
+            log.save()
+
+    ordered = [results[c] for c in configs]
+    failed = sum(1 for _, _, error in ordered if error is not None)
+    skipped = len(configs) - len(todo)
+    print(f"Готово: {len(ordered) - failed} из {len(ordered)} (пропущено без изменений: {skipped}), ошибок: {failed}")
+    return ordered
+
+
+def render_record(record, save_layer=False, overrides=None):
+    """render_card для строки списка (см. bulk.iter_records): (id строки, путь | None, ошибка | None)."""
+    row_id, config, error = record
+    if error is not None:
+        return row_id, None, error
+    try:
+        return row_id, process_card(config, save_layer=save_layer, overrides=overrides), None
+    except Exception as e:
+        return row_id, None, f"{type(e).__name__}: {e}"
+
+
+def render_records(path, workers=None, save_layer=False, manifest_path=BUILD_MANIFEST, force=False,
+                   overrides=None):
+    """
+    Пакетный рендер карточек из JSONL/CSV-списка (bulk.py). Строки читаются и
+    отдаются в пул по одной (не больше 2×workers вперёд), так что ни список,
+    ни результаты целиком в памяти не лежат (помнятся только занятые пути
+    результатов). Неизменившиеся строки пропускаются по манифесту сборки, как
+    в render_batch; строка с тем же результатом, что у одной из предыдущих,
+    не рендерится и считается ошибкой — иначе тихо затёрла бы чужой файл.
+
+    Returns:
+        (сколько строк, сколько с ошибкой)
+    """
+    manifest = BuildManifest(manifest_path) if manifest_path else None
+    digests = {}  # только для строк в работе
+    outputs = {}  # путь результата -> первая строка с ним
+    counts = {'total': 0, 'skipped': 0, 'failed': 0}
+
+    def todo():
+        for record in iter_records(path):
+            counts['total'] += 1
+            row_id, config, error = record
+            if error is not None:
+                yield record
+                continue
+            try:
+                if manifest is not None:
+                    output_path, digest = card_inputs_digest(manifest, config, overrides)
+                else:
+                    loaded = load_config(config)
+                    output_path = output_path_for(loaded, render_settings(loaded, overrides))
+            except Exception:
+                yield record  # пусть упадёт при рендере и попадёт в отчёт
+                continue
+            key = os.path.normpath(output_path)
+            if key in outputs:
+                yield row_id, None, f"тот же результат, что у {outputs[key]}: {output_path}"
+                continue
+            outputs[key] = row_id
+            if manifest is not None:
+                if not force and manifest.is_fresh(output_path, digest):
+                    counts['skipped'] += 1
+                    print(f"SKIP: {row_id} -> {output_path} (не изменилась)")
+                    continue
+                digests[row_id] = (output_path, digest)
+            yield record
+
+    try:
+        for row_id, output_path, error in ordered_map(render_record, todo(), workers, save_layer, overrides):
+            if error is None:
+                print(f"OK: {row_id} -> {output_path}")
+                if row_id in digests:
+                    manifest.record(*digests[row_id])
+            else:
+                counts['failed'] += 1
+                print(f"FAIL: {row_id} ({error})")
+            digests.pop(row_id, None)
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+    total, skipped, failed = counts['total'], counts['skipped'], counts['failed']
+    print(f"Готово: {total - failed} из {total} (пропущено без изменений: {skipped}), ошибок: {failed}")
+    return total, failed
+
+
+def render_card_pages(config_name, save_layer=False, settings=FINAL_SETTINGS):
+    """
+    Как render_card, но вместо PDF возвращает закодированные страницы —
+    (config_name, [EncodedImage] | None, error | None) для общего PDF на тираж.
+    """
+    try:
+        with tracing.card(config_name):
+            with span('config'):
+                config = load_config(config_name)
+            images = card_images(config, save_layer, shared_text_fields(config_name))
+            pages = []
+            for page in iter_pages(images, dpi=settings.dpi, resample=RESAMPLERS[settings.resample]):
+                with span('encode'):
+                    pages.append(encode_page(page))
+        return config_name, pages, None
     except Exception as e:
-        print(f"Ошибка: {e}")
+        return config_name, None, f"{type(e).__name__}: {e}"
+
+
+def render_combined(configs, output_pdf, workers=None, save_layer=False, overrides=None):
+    """
+    Рендерит все карточки в один PDF. Страницы пишутся по мере готовности и
+    сразу освобождаются, так что память не зависит от размера тиража.
+    Карточки с ошибкой в PDF не попадают, но есть в отчёте.
+    У документа одно разрешение: настройки — только запуска (overrides),
+    "render" из конфигов карточек здесь не действует.
+
+    Returns:
+        список (config_name, output_pdf | None, error) в порядке configs
+    """
+    settings = render_settings(None, overrides)
+    results = []
+    with PdfStreamWriter(output_pdf, settings.dpi) as pdf:
+        for config_name, pages, error in ordered_map(render_card_pages, configs, workers, save_layer, settings):
+            if error is None:
+                for page in pages:
+                    pdf.add_page(page)
+                print(f"OK: {config_name} -> {output_pdf} ({len(pages)} стр.)")
+                results.append((config_name, output_pdf, None))
+            else:
+                print(f"FAIL: {config_name} ({error})")
+                results.append((config_name, None, error))
+            del pages
+
+    failed = sum(1 for _, _, error in results if error is not None)
+    print(f"Готово: {len(results) - failed} из {len(results)}, ошибок: {failed}, "
+          f"страниц в {output_pdf}: {pdf.pages}")
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Рендер открыток из JSON-конфигов в PDF.')
+    ap.add_argument('configs', nargs='*', default=DEFAULT_CONFIGS,
+                    help='конфиги карточек или глобы (по умолчанию cards/[0-9]*.json)')
+    ap.add_argument('-j', '--workers', type=int, default=None,
+                    help='число процессов (по умолчанию — по числу ядер)')
+    ap.add_argument('-t', '--threads', type=int, default=None,
+                    help='один процесс с конвейером стадий на потоках: N потоков на стадию '
+                         '(вместо пула процессов; меньше памяти)')
+    ap.add_argument('--memory-budget', type=float, metavar='MB', default=None,
+                    help='сколько памяти могут занять одновременно рендерящиеся карточки, МБ '
+                         f'(по умолчанию {MEMORY_BUDGET_SHARE:.0%} свободной; 0 — без лимита)')
+    ap.add_argument('--preview', action=argparse.BooleanOptionalAction, default=None,
+                    help=f'быстрый предпросмотр: {PREVIEW_SETTINGS.dpi} dpi, {PREVIEW_SETTINGS.resample}, '
+                         f'{PREVIEW_SETTINGS.format} в <имя>.preview.*; --no-preview — финал даже для '
+                         'карточек с "render": {"preview": true}')
+    ap.add_argument('--dpi', type=int, default=None, help='разрешение рендера (поверх уровня)')
+    ap.add_argument('--resample', choices=sorted(RESAMPLERS), default=None, help='фильтр ресайза')
+    ap.add_argument('--format', choices=sorted(OUTPUT_FORMATS), default=None,
+                    help='pdf или картинка-превью со страницами рядом (png/jpeg)')
+    ap.add_argument('--watch', action='store_true',
+                    help='не выходить: следить за конфигами, фото, слоями и шрифтами и '
+                         'пересобирать только затронутые карточки (удобно с --preview)')
+    ap.add_argument('--interval', type=float, default=1.0, help='период опроса файлов в --watch, секунды')
+    ap.add_argument('--trace', metavar='JSONL',
+                    help='замерять стадии каждой карточки: запись на карточку в JSONL и сводка p50/p95')
+    ap.add_argument('--save-layer', action='store_true',
+                    help='сохранить слой с текстом в <output>.layer.png (отладка)')
+    ap.add_argument('--force', action='store_true',
+                    help='пересобрать все карточки, даже не изменившиеся')
+    ap.add_argument('--records', metavar='FILE',
+                    help='карточки из JSONL/CSV-списка (строка — parent и отличия), вместо конфигов')
+    ap.add_argument('--photo-cache', metavar='DIR',
+                    help='хранить обработанные фото ещё и на диске: повтор фото в других карточках, '
+                         'процессах пула и следующих запусках не декодируется заново')
+    ap.add_argument('--check', action='store_true',
+                    help='только проверить карточки по заголовкам (файлы, gravity, размер фото, '
+                         'повторы output_pdf) и вывести план с оценкой памяти, без рендера')
+    ap.add_argument('--combined', metavar='PDF',
+                    help='собрать все карточки в один PDF (потоково, без манифеста; --dpi/--resample '
+                         'действуют, --preview/--format/--force/--threads/--memory-budget — нет)')
+    args = ap.parse_args()
+    if args.combined:
+        # общий PDF: один формат, без манифеста и конвейера — эти флаги там ничего бы не сделали
+        unsupported = [flag for flag, value in (
+            ('--preview', args.preview), ('--format', args.format not in (None, 'pdf')),
+            ('--force', args.force), ('--threads', args.threads is not None),
+            ('--memory-budget', args.memory_budget is not None), ('--watch', args.watch),
+            ('--records', args.records),
+        ) if value]
+        if unsupported:
+            ap.error(f"с --combined не поддерживается: {', '.join(unsupported)} "
+                     "(PDF всегда собирается целиком; --dpi и --resample действуют)")
+    if args.records and not args.check:
+        # строки списка идут через utils.ordered_map — ни бюджета памяти, ни конвейера там нет
+        unsupported = [flag for flag, value in (
+            ('--memory-budget', args.memory_budget is not None), ('--threads', args.threads is not None),
+            ('--watch', args.watch),
+        ) if value]
+        if unsupported:
+            ap.error(f"с --records не поддерживается: {', '.join(unsupported)} (параллельность — через -j)")
+    if args.trace:
+        tracing.enable(args.trace)
+    if args.photo_cache:
+        set_photo_disk_cache(args.photo_cache)
+    overrides = {'preview': args.preview, 'dpi': args.dpi, 'resample': args.resample, 'format': args.format}
+
+    if args.memory_budget is None:
+        memory_budget = default_memory_budget()
+    else:
+        memory_budget = int(args.memory_budget * 2 ** 20) or None
+
+    if args.check:
+        from preflight import preflight  # preflight сам импортирует run
+        if args.records:
+            items = iter_records(args.records)
+        else:
+            items = ((path, path, None) for path in expand_configs(args.configs))
+        _, failed = preflight(items, overrides)
+        if failed:
+            raise SystemExit(1)
+        return
+
+    if args.watch:
+        watch(
+            lambda: expand_configs(args.configs),
+            card_dependencies,
+            lambda cards: render_batch(cards, workers=args.workers, save_layer=args.save_layer,
+                                       force=args.force, threads=args.threads,
+                                       memory_budget=memory_budget, overrides=overrides),
+            interval=args.interval,
+        )
+        return
+
+    if args.records:
+        _, failed = render_records(args.records, workers=args.workers, save_layer=args.save_layer,
+                                   force=args.force, overrides=overrides)
+    elif args.combined:
+        results = render_combined(expand_configs(args.configs), args.combined,
+                                  workers=args.workers, save_layer=args.save_layer, overrides=overrides)
+        failed = any(error is not None for _, _, error in results)
+    else:
+        results = render_batch(expand_configs(args.configs), workers=args.workers,
+                               save_layer=args.save_layer, force=args.force, threads=args.threads,
+                               memory_budget=memory_budget, overrides=overrides)
+        failed = any(error is not None for _, _, error in results)
+    if args.trace:
+        tracing.print_summary()
+    if failed:
+        raise SystemExit(1)
 
 
 if "__main__" == __name__:
-    for i in range(4):
-        id = i+1
-        process_card(f'cards/{id}.json')
\ No newline at end of file
+    main()
\ No newline at end of file
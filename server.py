@@ -0,0 +1,267 @@
+"""
+server.py — рендер-сервер: держит шрифты, слои и разрешённые конфиги в памяти
+между запросами, так что одиночная карточка не платит за запуск Python,
+импорт Pillow и загрузку ассетов.
+
+Слушает localhost по HTTP или Unix-сокет (--socket). Запросы обрабатываются
+параллельно (поток на запрос), одновременно рендерится не больше --workers.
+Клиент может назвать любой конфиг и фото и получить результат в ответе, так что
+сервер не для чужих: не-loopback --host — только с явным --allow-remote. Пишет
+он только внутри --output-root: "output" запроса (относительный — от корня) и
+output_pdf конфига вне корня отклоняются с 403.
+
+  POST /render   {"config": "cards/3.json"}            — путь к конфигу
+                 {"config": {"parent": ..., ...}}       — или сам конфиг
+                 необязательно: "output" — куда писать, "render" — настройки
+                 (как --preview/--dpi/...), "return": true — вернуть файл в ответе
+  GET  /stats    очередь, задержки (p50/p95/max), кэши
+  GET  /health
+
+Пример:
+  python server.py --port 8765
+  curl -s localhost:8765/render -d '{"config": "cards/3.json"}'
+  curl -s --unix-socket /tmp/cards.sock localhost/stats
+"""
+import argparse
+import ipaddress
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import assets
+from assets import PHOTO_CACHE_BYTES, set_photo_memory_limit
+from run import OUTPUT_FORMATS, load_config, output_path_for, process_card, render_settings
+
+LATENCY_WINDOW = 1000
+CONTENT_TYPES = {'.pdf': 'application/pdf', '.png': 'image/png', '.jpg': 'image/jpeg'}
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class RenderService:
+    """Рендер с ограничением параллельности и статистикой; сетевой слой — ниже."""
+
+    def __init__(self, workers=2, output_root='.'):
+        self.workers = workers
+        self.output_root = os.path.realpath(output_root)
+        self._slots = threading.Semaphore(workers)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.started = time.time()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)  # секунды от постановки в очередь до готового файла
+
+    def output_path(self, path, base=None):
+        """
+        Абсолютный путь результата, если он внутри output_root, иначе PermissionError.
+        Относительный path считается от base (по умолчанию — от output_root).
+        """
+        resolved = os.path.realpath(os.path.join(base or self.output_root, path))
+        if os.path.commonpath([self.output_root, resolved]) != self.output_root:
+            raise PermissionError(f"результат вне {self.output_root}: {path}")
+        return resolved
+
+    def render(self, config, output=None, overrides=None):
+        """Рендерит карточку, возвращает путь результата. Исключения — наружу."""
+        t0 = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+        with self._slots:
+            with self._lock:
+                self.waiting -= 1
+                self.running += 1
+            try:
+                path = process_card(config, overrides=overrides, output_path=output)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self.running -= 1
+        with self._lock:
+            self.done += 1
+            self._latencies.append(time.perf_counter() - t0)
+        return path
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            out = {
+                'workers': self.workers,
+                'queue_depth': self.waiting,
+                'running': self.running,
+                'done': self.done,
+                'failed': self.failed,
+                'uptime_s': round(time.time() - self.started, 1),
+            }
+        out['latency_s'] = {
+            'count': len(latencies),
+            'p50': _percentile(latencies, 0.5),
+            'p95': _percentile(latencies, 0.95),
+            'max': max(latencies) if latencies else None,
+        }
+        out['caches'] = assets.stats()
+        return out
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    service = None  # RenderService, задаётся в make_server
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.service.stats())
+        elif self.path == '/health':
+            self._send_json(200, {'ok': True})
+        else:
+            self._send_json(404, {'error': f'нет такого пути: {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/render':
+            self._send_json(404, {'error': f'нет такого пути: {self.path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            config = request['config']
+            if not isinstance(config, (str, dict)):
+                raise TypeError('"config" — путь к JSON или объект конфига')
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': f"плохой запрос: {type(e).__name__}: {e}"})
+            return
+
+        overrides = request.get('render')
+        output = request.get('output')
+        tmp_path = None
+        t0 = time.perf_counter()
+        try:
+            loaded = load_config(config)
+            settings = render_settings(loaded, overrides)
+            if request.get('return') and output is None:
+                # вернуть файл, не оставляя его на диске
+                fd, tmp_path = tempfile.mkstemp(suffix=OUTPUT_FORMATS[settings.format])
+                os.close(fd)
+                output = tmp_path
+            else:
+                try:
+                    if output is not None:
+                        output = self.service.output_path(output)
+                    else:
+                        # output_pdf конфига — как у run.py, от текущей папки
+                        output = self.service.output_path(output_path_for(loaded, settings),
+                                                          os.getcwd())
+                except PermissionError as e:
+                    self._send_json(403, {'error': str(e)})
+                    return
+            path = self.service.render(config, output, overrides)
+        except Exception as e:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._send_json(500, {'error': f"{type(e).__name__}: {e}"})
+            return
+        seconds = round(time.perf_counter() - t0, 3)
+
+        if not request.get('return'):
+            self._send_json(200, {'output': path, 'seconds': seconds})
+            return
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            if tmp_path is not None:
+                os.remove(tmp_path)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream'))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Render-Seconds', str(seconds))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # у Unix-сокета адреса клиента нет
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(service, host='127.0.0.1', port=8765, socket_path=None):
+    handler = type('Handler', (RenderHandler,), {'service': service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def is_loopback(host):
+    """Адрес только для этой машины (127.0.0.0/8, ::1, localhost)."""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Рендер-сервер карточек: ассеты и конфиги остаются в памяти.')
+    ap.add_argument('--host', default='127.0.0.1', help='адрес HTTP (по умолчанию только localhost)')
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--allow-remote', action='store_true',
+                    help='разрешить --host не-loopback: клиенты смогут читать файлы машины через конфиги')
+    ap.add_argument('--output-root', default='.', metavar='DIR',
+                    help='куда серверу можно писать результаты (по умолчанию текущая папка)')
+    ap.add_argument('--socket', metavar='PATH', help='слушать Unix-сокет вместо TCP')
+    ap.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                    help='сколько карточек рендерить одновременно')
+    ap.add_argument('--photo-cache-mb', type=float, default=PHOTO_CACHE_BYTES / 2 ** 20,
+                    help='память под кэш обработанных фото, МБ (0 — без кэша)')
+    args = ap.parse_args()
+    if not args.socket and not args.allow_remote and not is_loopback(args.host):
+        ap.error(f"--host {args.host} доступен не только с этой машины; если так и нужно — --allow-remote")
+    # сервер для того и держится, чтобы повторы не считались заново
+    set_photo_memory_limit(args.photo_cache_mb * 2 ** 20)
+
+    service = RenderService(args.workers, args.output_root)
+    server = make_server(service, args.host, args.port, args.socket)
+    where = args.socket or f"http://{args.host}:{args.port}"
+    print(f"Сервер рендера: {where}, одновременно карточек: {args.workers}, "
+          f"кэш фото: {args.photo_cache_mb:.0f} МБ, результаты — в {service.output_root}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Остановлен")
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if "__main__" == __name__:
+    main()
@@ -0,0 +1,199 @@
+"""
+tracing.py — опциональные замеры стадий рендера карточки.
+
+Включается tracing.enable(path) (run.py --trace FILE). На каждую карточку в
+JSONL-файл пишется одна запись: время и пик памяти по стадиям (config, layout,
+text, decode, exif, crop, rotate, resize, transpose, compose, encode, ...)
+и заметки (размеры картинок и т.п.). summarize() сводит файл в p50/p95 по стадиям.
+
+Выключенный трейсинг ничего не стоит: span() возвращает один и тот же пустой
+контекст, note() сразу выходит. Процессы пула включают его сами — путь
+передаётся через переменную окружения.
+
+Пик памяти — по процессу (VmHWM): он сбрасывается один раз на входе в card(),
+стадии его не трогают, а пишут peak_mb — пик карточки от её старта к концу
+стадии (где он скачет — та стадия и съела память). Пока в процессе рендерится
+больше одной карточки (конвейер на потоках, сервер), пик общий на всех — тогда
+память не пишется вовсе.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+from memory import peak_rss, reset_peak_rss
+
+TRACE_ENV = 'CARDS_TRACE'
+
+_path = os.environ.get(TRACE_ENV) or None
+_local = threading.local()
+_write_lock = threading.Lock()
+_NULL = contextlib.nullcontext()
+# Сколько карточек сейчас внутри card(): пик памяти осмыслен, только пока она одна
+_active = 0
+_active_lock = threading.Lock()
+
+
+def enable(path):
+    """Включить трейсинг в этом процессе и в порождённых; файл начинается заново."""
+    global _path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    open(path, 'w').close()
+    os.environ[TRACE_ENV] = path
+    _path = path
+
+
+def enabled():
+    return _path is not None
+
+
+def new_record(card):
+    return {'card': card if isinstance(card, str) else '<inline>', 'stages': {}, 'notes': {},
+            '_t0': time.perf_counter()}
+
+
+@contextlib.contextmanager
+def card(name):
+    """Трейс одной карточки в этом потоке: пишется при выходе (и при ошибке)."""
+    if _path is None:
+        yield
+        return
+    global _active
+    record = new_record(name)
+    with _active_lock:
+        _active += 1
+        alone = _active == 1
+    if alone:
+        base = reset_peak_rss()
+        if base is not None:
+            record['_rss_base'] = base
+    with resume(record):
+        try:
+            yield
+        except BaseException as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            peak_mb = _peak_mb(record)
+            if peak_mb is not None:
+                record['peak_mb'] = peak_mb
+            with _active_lock:
+                _active -= 1
+            finish(record)
+
+
+def _peak_mb(record):
+    """Пик RSS с начала карточки, МБ; None — не замеряется (не Linux или карточка не одна)."""
+    base = record.get('_rss_base')
+    if base is None or _active != 1:
+        return None
+    return round((peak_rss() - base) / 2 ** 20, 1)
+
+
+@contextlib.contextmanager
+def resume(record):
+    """Продолжить запись record в этом потоке (конвейер: стадии карточки в разных потоках)."""
+    if _path is None or record is None:
+        yield
+        return
+    prev = getattr(_local, 'record', None)
+    _local.record = record
+    try:
+        yield
+    finally:
+        _local.record = prev
+
+
+def finish(record, output=None):
+    """Дописывает запись карточки в файл трейса."""
+    if _path is None or record is None:
+        return
+    record = dict(record)
+    record['total_s'] = round(time.perf_counter() - record.pop('_t0'), 4)
+    record.pop('_rss_base', None)
+    if output is not None:
+        record['output'] = output
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    with _write_lock:
+        with open(_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+class _Span:
+    __slots__ = ('record', 'name', 't0')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        stage = self.record['stages'].setdefault(self.name, {'s': 0.0, 'calls': 0})
+        stage['s'] = round(stage['s'] + dt, 4)
+        stage['calls'] += 1
+        # без сброса: вложенные стадии и внешняя видят один и тот же пик карточки
+        peak_mb = _peak_mb(self.record)
+        if peak_mb is not None:
+            stage['peak_mb'] = max(stage.get('peak_mb', 0.0), peak_mb)
+        return False
+
+
+def span(name):
+    """with span('decode'): ... — стадия текущей карточки; без трейсинга — пустой контекст."""
+    if _path is None:
+        return _NULL
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return _NULL
+    return _Span(record, name)
+
+
+def note(key, value):
+    """Заметка к трейсу текущей карточки (вместо отладочного print); по ключу — список значений."""
+    if _path is None:
+        return
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record['notes'].setdefault(key, []).append(value)
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(path=None):
+    """
+    Сводка по файлу трейса: {стадия: {'count', 'p50', 'p95', 'max'}} в секундах,
+    плюс 'total' — время карточки целиком.
+    """
+    path = path or _path
+    durations = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            durations.setdefault('total', []).append(record['total_s'])
+            for name, stage in record['stages'].items():
+                durations.setdefault(name, []).append(stage['s'])
+    return {
+        name: {'count': len(values), 'p50': _percentile(values, 0.5),
+               'p95': _percentile(values, 0.95), 'max': max(values)}
+        for name, values in durations.items()
+    }
+
+
+def print_summary(path=None):
+    summary = summarize(path)
+    if not summary:
+        return
+    print(f"{'стадия':<12} {'карточек':>8} {'p50, ms':>9} {'p95, ms':>9} {'max, ms':>9}")
+    for name, s in sorted(summary.items(), key=lambda kv: (kv[0] == 'total', -kv[1]['p95'])):
+        print(f"{name:<12} {s['count']:>8} {s['p50'] * 1000:>9.1f} {s['p95'] * 1000:>9.1f} {s['max'] * 1000:>9.1f}")
+    print(f"Трейс: {path or _path}")
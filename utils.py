@@ -1,13 +1,23 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
+from itertools import chain
+import hashlib
 import json
+import os
+import threading
 
 class MergeTypeError(TypeError):
     pass
 
+class ConfigCycleError(ValueError):
+    pass
+
 def deep_merge(a, b, *,
                list_strategy='extend',   # 'extend' | 'unique' | 'by_index' | 'by_key'
                list_key=None,            # ключ для 'by_key'
                conflict='right',         # 'right' | 'left' | 'raise' | 'both'
+               copy=True,                # False — без копирования, с общими поддеревьями
                _level=0):
     """
     Глубокий merge двух структур из dict/list/скаляров.
@@ -20,46 +30,88 @@ def deep_merge(a, b, *,
           'left'  -> вернуть a
           'raise' -> кинуть MergeTypeError
           'both'  -> вернуть [a, b]
+
+    copy=True  — результат не делит объектов с a и b (всё через deepcopy).
+    copy=False — нетронутые поддеревья a и b попадают в результат как есть, новые
+                 контейнеры создаются только на путях слияния. Такой результат
+                 нельзя менять на месте, пока a и b ещё нужны.
+
+    Обход итеративный (стек генераторов вместо рекурсии), так что вложенность
+    не упирается в лимит рекурсии; при copy=True её всё равно ограничивает deepcopy.
     """
+    opts = (list_strategy, list_key, conflict, copy)
+    stack = [_merge_steps(a, b, _level, False, opts)]
+    value = None
+    while True:
+        try:
+            sub = stack[-1].send(value)
+        except StopIteration as done:
+            stack.pop()
+            if not stack:
+                return done.value
+            value = done.value
+            continue
+        stack.append(_merge_steps(*sub, opts))
+        value = None
+
+
+def _same(x):
+    return x
+
+
+def _both_containers(a, b):
+    return (isinstance(a, dict) and isinstance(b, dict)) or (isinstance(a, list) and isinstance(b, list))
+
+
+def _merge_steps(a, b, _level, fresh, opts):
+    """
+    Один узел deep_merge. Вложенный merge не вызывается рекурсивно, а
+    запрашивается через `yield (a, b, level, fresh)`; результат приходит в send.
+
+    fresh=True — в режиме без копий a стоит на месте, где раньше была его
+    deepcopy, так что совпадение контейнеров по `is` не считается.
+    """
+    list_strategy, list_key, conflict, copy = opts
+    dup = deepcopy if copy else _same
+    # в режиме копий дети — настоящие копии; без копий — помечаем их fresh
+    fresh_child = not copy
+
     # Быстрые тривиальные случаи
-    if a is b:
+    if a is b and not (fresh and isinstance(a, (dict, list))):
         return a
     if a is None:
-        return deepcopy(b)
+        return dup(b)
     if b is None:
-        return deepcopy(a)
+        return dup(a)
 
     # dict + dict
     if isinstance(a, dict) and isinstance(b, dict):
-        out = {}
         # сначала копия a
-        for k, v in a.items():
-            out[k] = deepcopy(v)
+        out = {k: deepcopy(v) for k, v in a.items()} if copy else dict(a)
         # затем мержим b
         for k, v in b.items():
             if k in out:
-                out[k] = deep_merge(out[k], v,
-                                   list_strategy=list_strategy,
-                                   list_key=list_key,
-                                   conflict=conflict,
-                                   _level=_level+1)
+                if _both_containers(out[k], v):
+                    out[k] = yield (out[k], v, _level+1, fresh_child)
+                else:
+                    out[k] = _merge_leaf(out[k], v, _level+1, conflict, dup)
             else:
-                out[k] = deepcopy(v)
+                out[k] = dup(v)
         return out
 
     # list + list
     if isinstance(a, list) and isinstance(b, list):
         if list_strategy == 'extend':
-            return deepcopy(a) + deepcopy(b)
+            return dup(a) + dup(b)
 
         if list_strategy == 'unique':
             seen = set()
             out = []
-            for item in a + b:
+            for item in chain(a, b):
                 marker = _hashable_marker(item)
                 if marker not in seen:
                     seen.add(marker)
-                    out.append(deepcopy(item))
+                    out.append(dup(item))
             return out
 
         if list_strategy == 'by_index':
@@ -67,16 +119,13 @@ def deep_merge(a, b, *,
             la, lb = len(a), len(b)
             m = min(la, lb)
             for i in range(m):
-                out.append(
-                    deep_merge(a[i], b[i],
-                               list_strategy=list_strategy,
-                               list_key=list_key,
-                               conflict=conflict,
-                               _level=_level+1)
-                )
+                if _both_containers(a[i], b[i]):
+                    out.append((yield (a[i], b[i], _level+1, fresh)))
+                else:
+                    out.append(_merge_leaf(a[i], b[i], _level+1, conflict, dup))
             # остаток более длинного списка
             tail = a[m:] if la > lb else b[m:]
-            out.extend(deepcopy(tail))
+            out.extend(dup(tail))
             return out
 
         if list_strategy == 'by_key':
@@ -86,56 +135,55 @@ def deep_merge(a, b, *,
             # Индексация по ключу
             index = {}
             order = []  # сохраняем общий порядок появления ключей
-            def add_item(it, source):
+            for it, source in chain(((it, 'a') for it in a), ((it, 'b') for it in b)):
                 if isinstance(it, dict) and list_key in it:
                     k = it[list_key]
                     if k not in index:
-                        index[k] = deepcopy(it)
+                        index[k] = dup(it)
                         order.append((k, source))
                     else:
-                        index[k] = deep_merge(index[k], it,
-                                              list_strategy=list_strategy,
-                                              list_key=list_key,
-                                              conflict=conflict,
-                                              _level=_level+1)
+                        index[k] = yield (index[k], it, _level+1, fresh_child)
                 else:
                     # Элемент без ключа просто добавим с уникальным маркером
                     order.append((object(), source))
-                    index[order[-1][0]] = deepcopy(it)
+                    index[order[-1][0]] = dup(it)
 
-            for it in a:
-                add_item(it, 'a')
-            for it in b:
-                add_item(it, 'b')
-
-            # восстанавливаем порядок: сначала те, что встречались в a, потом новые из b
-            # но мы уже добавляли в порядке добавления, так что просто собрать
+            # order уже в порядке появления: сначала из a, потом новые из b.
+            # Один и тот же объект дважды не кладём (так схлопываются одинаковые
+            # скаляры без ключа); контейнеры без копий раньше всегда были
+            # разными копиями — их не схлопываем.
             out = []
+            added_ids = set()
             for k, _src in order:
-                # может быть дубликат пары (k, 'a') и потом (k, 'b'); мы оставляем одно,
-                # потому что index[k] уже содержит слитое значение
                 if k is not None:
-                    # защищаемся от повторов в order
-                    if not out or out[-1] is not index[k]:
-                        out.append(index[k])
-            # Удалим возможные повторяющиеся ссылки
-            unique_out = []
-            added_ids = set()
-            for item in out:
-                if id(item) not in added_ids:
-                    unique_out.append(item)
-                    added_ids.add(id(item))
-            return unique_out
+                    item = index[k]
+                    if not copy and isinstance(item, (dict, list)):
+                        out.append(item)
+                    elif id(item) not in added_ids:
+                        out.append(item)
+                        added_ids.add(id(item))
+            return out
 
         raise ValueError(f"Неизвестная стратегия списка: {list_strategy}")
 
     # типы не совпали или скаляр+что-то
+    return _merge_leaf(a, b, _level, conflict, dup)
+
+
+def _merge_leaf(a, b, _level, conflict, dup):
+    """Merge, где хотя бы одна сторона — не контейнер того же типа."""
+    if a is b:
+        return a
+    if a is None:
+        return dup(b)
+    if b is None:
+        return dup(a)
     if conflict == 'right':
-        return deepcopy(b)
+        return dup(b)
     if conflict == 'left':
-        return deepcopy(a)
+        return dup(a)
     if conflict == 'both':
-        return [deepcopy(a), deepcopy(b)]
+        return [dup(a), dup(b)]
     if conflict == 'raise':
         raise MergeTypeError(f"Конфликт типов на уровне {_level}: {type(a).__name__} vs {type(b).__name__}")
     raise ValueError(f"Неизвестная политика conflict: {conflict}")
@@ -143,6 +191,8 @@ def deep_merge(a, b, *,
 
 def _hashable_marker(x):
     """Делаем маркер для сравнения уникальности в списках."""
+    if x is None or isinstance(x, (str, int, float)):
+        return ('scalar', x)
     if isinstance(x, dict):
         return ('dict', tuple(sorted((k, _hashable_marker(v)) for k, v in x.items())))
     if isinstance(x, list):
@@ -157,3 +207,190 @@ def _hashable_marker(x):
 def read_json(path):
     with open(path, encoding='utf-8') as f:
         return json.load(f)
+
+
+def _copy_tree(x):
+    """Копия dict/list-дерева из JSON: скаляры неизменяемы, их не копируем."""
+    if isinstance(x, dict):
+        return {k: _copy_tree(v) for k, v in x.items()}
+    if isinstance(x, list):
+        return [_copy_tree(v) for v in x]
+    return x
+
+
+class ConfigResolver:
+    """
+    Разрешает конфиги с цепочкой "parent" любой глубины.
+
+    Каждый файл парсится один раз и кэшируется по пути и mtime; разрешённые
+    родители тоже кэшируются, так что сотни карточек на одном global.json
+    не читают и не мержат его заново. Циклы в цепочке — ConfigCycleError.
+    Путь в "parent" — относительно текущей папки, как и раньше.
+    """
+
+    def __init__(self, **merge_options):
+        self.merge_options = merge_options
+        self._raw = {}       # путь -> (mtime_ns, данные файла)
+        self._resolved = {}  # путь -> (зависимости [(путь, mtime_ns)], разрешённый конфиг)
+
+    def read(self, path):
+        """Сырой JSON файла (без учёта parent). Не менять — это объект из кэша."""
+        key = os.path.normpath(path)
+        mtime = os.stat(key).st_mtime_ns
+        cached = self._raw.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, read_json(key))
+            self._raw[key] = cached
+        return cached[1]
+
+    def resolve(self, path):
+        """Итоговый конфиг со всеми родителями — свежая копия, её можно менять."""
+        return _copy_tree(self._resolve(os.path.normpath(path), ())[1])
+
+    def resolve_inline(self, raw):
+        """Как resolve, но для уже разобранного конфига (dict) — родители из кэша."""
+        if "parent" not in raw:
+            return _copy_tree(raw)
+        parent = self._resolve(os.path.normpath(raw["parent"]), ())[1]
+        return _copy_tree(deep_merge(parent, raw, copy=False, **self.merge_options))
+
+    def dependencies(self, path):
+        """Файлы, из которых собран конфиг: он сам и вся цепочка родителей."""
+        return [p for p, _ in self._resolve(os.path.normpath(path), ())[0]]
+
+    def _resolve(self, key, stack):
+        if key in stack:
+            raise ConfigCycleError("Цикл в цепочке parent: " + " -> ".join(stack + (key,)))
+
+        cached = self._resolved.get(key)
+        if cached is not None and all(mtime_ns(p) == m for p, m in cached[0]):
+            return cached
+
+        raw = self.read(key)
+        deps = [(key, self._raw[key][0])]
+        if "parent" in raw:
+            parent_deps, parent = self._resolve(os.path.normpath(raw["parent"]), stack + (key,))
+            # кэш никто не меняет, так что родителя можно не копировать
+            config = deep_merge(parent, raw, copy=False, **self.merge_options)
+            deps += parent_deps
+        else:
+            config = raw
+        cached = (deps, config)
+        self._resolved[key] = cached
+        return cached
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha256 содержимого файла (hex), читается кусками."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def mtime_ns(path):
+    """st_mtime_ns файла — для ключей кэшей и опроса изменений; None, если файла нет."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+_default_resolver = ConfigResolver()
+
+
+def resolve_config(path):
+    """Конфиг со всеми родителями через общий (на процесс) кэширующий резолвер."""
+    return _default_resolver.resolve(path)
+
+
+def resolve_inline_config(raw):
+    """Конфиг-словарь (не файл) со всеми родителями через общий резолвер."""
+    return _default_resolver.resolve_inline(raw)
+
+
+def config_dependencies(path):
+    """Файлы конфига: он сам и вся цепочка parent (через общий резолвер)."""
+    return _default_resolver.dependencies(path)
+
+
+def read_config(path):
+    """Сырой конфиг файла без родителей (объект из кэша резолвера — не менять)."""
+    return _default_resolver.read(path)
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш с лимитом по числу записей и/или по суммарному
+    «весу» (например, байтам). При переполнении выкидываются давно не использованные.
+    """
+
+    def __init__(self, max_items=None, max_weight=None):
+        self.max_items = max_items
+        self.max_weight = max_weight
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # ключ -> (значение, вес)
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, weight=1):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._weight -= old[1]
+            if self.max_weight is not None and weight > self.max_weight:
+                # больше всего кэша — не кладём, чтобы не выкинуть всё остальное
+                return
+            self._data[key] = (value, weight)
+            self._weight += weight
+            while self._data and (
+                (self.max_items is not None and len(self._data) > self.max_items)
+                or (self.max_weight is not None and self._weight > self.max_weight)
+            ):
+                _, (_, w) = self._data.popitem(last=False)
+                self._weight -= w
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def weight(self):
+        return self._weight
+
+
+def ordered_map(fn, items, workers, *args):
+    """
+    fn(item, *args) по items на пуле процессов, результаты — в порядке items.
+    Вперёд запускается не больше 2×workers задач, так что готовые, но ещё
+    не забранные результаты не копятся в памяти.
+    """
+    if workers == 1:
+        for item in items:
+            yield fn(item, *args)
+        return
+    window = 2 * (workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
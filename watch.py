@@ -0,0 +1,99 @@
+"""
+watch.py — пересборка только тех карточек, чьи файлы изменились.
+
+Граф зависимостей: карточка -> её JSON, цепочка parent, фото, слой и шрифты.
+Файлы опрашиваются по mtime (без внешних зависимостей вроде watchdog); при
+изменении пересобираются только зависящие от файла карточки. Правка
+cards/global_vertical.json затронет только вертикальные карточки, правка
+одного фото — только карточку с этим фото.
+"""
+import os
+import time
+
+from utils import mtime_ns
+
+
+class DependencyGraph:
+    """Карточка -> множество файлов и обратно: файл -> карточки, которые от него зависят."""
+
+    def __init__(self):
+        self.files = {}       # карточка -> {путь}
+        self.dependents = {}  # путь -> {карточка}
+
+    def set(self, card, files):
+        self.remove(card)
+        files = {os.path.normpath(f) for f in files}
+        self.files[card] = files
+        for f in files:
+            self.dependents.setdefault(f, set()).add(card)
+
+    def remove(self, card):
+        for f in self.files.pop(card, ()):
+            cards = self.dependents.get(f)
+            if cards is not None:
+                cards.discard(card)
+                if not cards:
+                    del self.dependents[f]
+
+    def affected(self, changed_files):
+        out = set()
+        for f in changed_files:
+            out |= self.dependents.get(os.path.normpath(f), set())
+        return out
+
+
+def watch(list_cards, dependencies, rebuild, interval=1.0, initial=True):
+    """
+    Бесконечный цикл опроса (выход — Ctrl+C).
+
+    Args:
+        list_cards: () -> список карточек (вызывается на каждом опросе — новые
+                    карточки подхватываются сразу)
+        dependencies: карточка -> файлы, от которых она зависит; может упасть
+                      (скажем, JSON недописан) — тогда следим за прошлыми файлами
+                      и самой карточкой
+        rebuild: список карточек -> None, пересобирает их
+        interval: пауза между опросами, секунды
+        initial: собрать всё при старте
+    """
+    graph = DependencyGraph()
+
+    def refresh(card):
+        try:
+            files = set(dependencies(card))
+        except Exception as e:
+            print(f"WATCH: {card}: зависимости не прочитать ({type(e).__name__}: {e})")
+            files = set(graph.files.get(card, ()))
+        graph.set(card, files | {card})
+
+    cards = list(list_cards())
+    for card in cards:
+        refresh(card)
+    mtimes = {f: mtime_ns(f) for f in graph.dependents}
+    if initial and cards:
+        rebuild(cards)
+    print(f"WATCH: слежу за {len(graph.dependents)} файлами {len(cards)} карточек, Ctrl+C — выход")
+
+    try:
+        while True:
+            time.sleep(interval)
+            current = list(list_cards())
+            known = set(graph.files)
+            for card in known - set(current):
+                graph.remove(card)
+
+            changed = [f for f in graph.dependents if mtime_ns(f) != mtimes.get(f)]
+            todo = graph.affected(changed) | (set(current) - known)
+            if not todo:
+                continue
+
+            todo = [card for card in current if card in todo]
+            if changed:
+                print(f"WATCH: изменились {', '.join(sorted(changed))} -> пересобираю {len(todo)}")
+            # зависимости могли поменяться (другое фото, другой parent)
+            for card in todo:
+                refresh(card)
+            mtimes = {f: mtime_ns(f) for f in graph.dependents}
+            rebuild(todo)
+    except KeyboardInterrupt:
+        print("WATCH: остановлено")